@@ -0,0 +1,93 @@
+##############################################################################
+#
+# Copyright (c) 2011 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.0 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""In-memory caches shared by all threads.
+"""
+
+import threading
+from time import time
+
+
+class LRUCache:
+    """Bounded mapping that discards the least recently used entries.
+
+    Note: instances of this class are shared across threads.
+    """
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = {}  # key -> [value, expires, last_used]
+        self._clock = 0
+
+    def get(self, key, default=None):
+        """Returns a cached value, or the default if missing or expired.
+        """
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            if entry[1] is not None and entry[1] < time():
+                del self._entries[key]
+                return default
+            self._clock += 1
+            entry[2] = self._clock
+            return entry[0]
+        finally:
+            self._lock.release()
+
+    def set(self, key, value, ttl=None):
+        """Stores a value.
+
+        If ttl is given, the entry expires after that many seconds.
+        """
+        if ttl:
+            expires = time() + ttl
+        else:
+            expires = None
+        self._lock.acquire()
+        try:
+            self._clock += 1
+            self._entries[key] = [value, expires, self._clock]
+            if len(self._entries) > self.max_entries:
+                self._evict()
+        finally:
+            self._lock.release()
+
+    def _evict(self):
+        # Discard the oldest quarter in one pass so that the cost of
+        # sorting is spread over many insertions.
+        items = self._entries.items()
+        items.sort(key=lambda item: item[1][2])
+        excess = len(items) - self.max_entries + self.max_entries // 4
+        for key, entry in items[:excess]:
+            del self._entries[key]
+
+    def invalidate(self, key):
+        """Removes an entry if it exists.
+        """
+        self._lock.acquire()
+        try:
+            self._entries.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._entries)
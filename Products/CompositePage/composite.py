@@ -17,6 +17,7 @@ $Id: composite.py,v 1.24 2004/04/15 22:13:44 shane Exp $
 
 import os
 import re
+from time import time
 
 import Globals
 import Acquisition
@@ -24,26 +25,82 @@ from Acquisition import aq_base
 from Acquisition import aq_inner
 from Acquisition import aq_parent
 from Acquisition import aq_get
+from App.Common import rfc1123_date
 from OFS.Folder import Folder
 from OFS.SimpleItem import SimpleItem
 from Products.PageTemplates.PageTemplateFile import PageTemplateFile
 from Products.PageTemplates.ZopePageTemplate import ZopePageTemplate
 from AccessControl import ClassSecurityInfo
+from AccessControl import getSecurityManager
 from AccessControl.ZopeGuards import guarded_getattr
+from ZODB.POSException import ConflictError
 from zope.interface import implements
 
 from Products.CompositePage.interfaces import IComposite
+from Products.CompositePage.interfaces import ICompositeElement
 from Products.CompositePage.interfaces import ISlot
 from Products.CompositePage.interfaces import ISlotGenerator
 from Products.CompositePage.interfaces import CompositeError
 from Products.CompositePage.slot import Slot
 from Products.CompositePage.slot import getIconURL
 from Products.CompositePage.slot import formatException
+from Products.CompositePage.slotexpr import findSlotSpecs
 from Products.CompositePage.perm_names import view_perm
 from Products.CompositePage.perm_names import change_composites_perm
+from Products.CompositePage.cache import LRUCache
+from Products.CompositePage.utils import getSerial
+from Products.CompositePage.element import prefetchElements
+from Products.CompositePage.rawfile import makeETag
+from Products.CompositePage.rawfile import matchesETag
 
 _www = os.path.join(os.path.dirname(__file__), "www")
 
+charset_search = re.compile(r"charset=([-_a-zA-Z0-9]+)", re.IGNORECASE).search
+
+# Splits a page at the markers of deferred elements (see deferred_tag).
+deferred_split = re.compile(r"(<!--deferred element [0-9a-f]{32}-->)").split
+
+# Rendered pages: path -> (dependencies, text)
+_render_cache = LRUCache(500)
+
+try:
+    from zope.testing.cleanup import addCleanUp
+except ImportError:
+    pass
+else:
+    addCleanUp(_render_cache.clear)
+
+
+def _getFileVersion(ob):
+    """Returns what identifies the version of a template read from a file.
+
+    Page template files and skin objects are not stored in the
+    database, so they have no serial.  Their file and its modification
+    time take its place.  They reload first when they would (in debug
+    mode), so that a changed file counts as a change.  Returns None
+    for other objects.
+    """
+    base = aq_base(ob)
+    if getattr(base, '_p_oid', None) is not None:
+        # Stored, but not saved yet.
+        return None
+    if getattr(base, '_filepath', None) is not None:
+        # A CMF filesystem object.
+        ob._updateFromFS()
+        mtime = getattr(base, '_file_mod_time', None)
+        filename = base._filepath
+    elif (getattr(base, 'filename', None) is not None
+          and hasattr(base, '_cook_check')):
+        # A PageTemplateFile.
+        ob._cook_check()
+        mtime = getattr(base, '_v_last_read', None)
+        filename = base.filename
+    else:
+        return None
+    if not mtime:
+        return None
+    return ('file', filename, mtime)
+
 
 class SlotGenerator(Acquisition.Explicit):
     """Automatically makes slots available to the template.
@@ -64,7 +121,7 @@ class SlotGenerator(Acquisition.Explicit):
         composite._usingSlot(name, class_name, title)
         slots = composite.filled_slots
         if slots.hasObject(name):
-            return slots[name]
+            s = slots[name]
         else:
             # Generate a new slot.
             s = self._slot_class(name)
@@ -72,7 +129,10 @@ class SlotGenerator(Acquisition.Explicit):
                 # Persist the slot.
                 slots._setObject(s.getId(), s)
             # else don't persist the slot.
-            return s.__of__(slots)
+            s = s.__of__(slots)
+        # Let the elements find their slot class while rendering.
+        s._v_class_name = class_name
+        return s
 
     __getitem__ = get
 
@@ -98,7 +158,15 @@ class CompositeMixin:
     template_path = "template"
     _v_editing = 0
     _v_rendering = 0
+    _v_render_deadline = None  # Set while rendering with a budget
+    _v_timed_out = 0  # Set when an element ran out of time
+    _v_esi = 0  # Set while rendering Edge Side Includes
+    _v_deferred = None  # marker -> (slot, item, class name) while streaming
     _v_slot_specs = None  # [{'name', 'class', 'title'}]
+    render_cache_enabled = 0
+    render_budget = 0.0
+    use_esi = 0
+    esi_shell_ttl = 0
 
     security.declarePublic("slots")
     slots = SlotGenerator()
@@ -106,6 +174,14 @@ class CompositeMixin:
     _properties = (
         {"id": "template_path", "mode": "w", "type": "string",
          "label": "Path to template"},
+        {"id": "render_cache_enabled", "mode": "w", "type": "boolean",
+         "label": "Cache pages rendered for anonymous users"},
+        {"id": "render_budget", "mode": "w", "type": "float",
+         "label": "Seconds allowed for rendering elements (0 = no limit)"},
+        {"id": "use_esi", "mode": "w", "type": "boolean",
+         "label": "Render elements as Edge Side Includes for proxies"},
+        {"id": "esi_shell_ttl", "mode": "w", "type": "int",
+         "label": "Seconds proxies may cache the page around the includes"},
         )
 
     security.declareProtected(view_perm, "hasTemplate")
@@ -137,19 +213,254 @@ class CompositeMixin:
         if self._v_rendering:
             raise CompositeError("Circular composite reference")
         self._v_rendering = 1
+        self._v_timed_out = 0
         try:
             template = self.getTemplate()
-            return template(composite=self)
+            self._prefetchElements()
+            esi = self._acceptsESI()
+            if esi:
+                self._v_esi = 1
+                self.REQUEST.RESPONSE.setHeader(
+                    'Surrogate-Control', 'content="ESI/1.0"')
+            publishing = self._isPublished()
+            anonymous = self._isAnonymous()
+            caching = (self.render_cache_enabled and anonymous
+                       and not self._v_editing)
+            ttl = 0
+            if publishing and anonymous:
+                ttl = self._getPageTTL(template, esi)
+            deps = None
+            if caching or ttl:
+                deps = self._getRenderDeps(template)
+            path = self._getRenderPath() + (esi,)
+            etag = None
+            if publishing and deps is not None:
+                user = getSecurityManager().getUser()
+                etag = makeETag(repr((path, deps, user.getId())))
+                if matchesETag(self.REQUEST, (etag,)):
+                    response = self.REQUEST.RESPONSE
+                    response.setHeader('ETag', etag)
+                    self._setCachePolicy(ttl)
+                    response.setStatus(304)
+                    return ''
+            text = None
+            if caching and deps is not None:
+                cached = _render_cache.get(path)
+                if cached is not None and cached[0] == deps:
+                    text = cached[1]
+            if text is None:
+                if self.render_budget:
+                    self._v_render_deadline = time() + self.render_budget
+                text = template(composite=self)
+                if caching and deps is not None and not self._v_timed_out:
+                    # Don't keep pages with missing elements.
+                    _render_cache.set(path, (deps, text))
+            if publishing:
+                if etag is not None and not self._v_timed_out:
+                    self.REQUEST.RESPONSE.setHeader('ETag', etag)
+                self._setCachePolicy(ttl)
+            return text
         finally:
             self._v_rendering = 0
+            self._v_render_deadline = None
+            self._v_esi = 0
 
     view = __call__
 
+    def _acceptsESI(self):
+        """Returns true if slots should render as Edge Side Includes.
+
+        Requires the use_esi property and a proxy that announces ESI
+        support in the Surrogate-Capability request header, so that
+        browsers never see the include tags.
+        """
+        if not self.use_esi or self._v_editing:
+            return 0
+        req = getattr(self, "REQUEST", None)
+        if req is None:
+            return 0
+        capability = req.get_header('Surrogate-Capability', None) or ''
+        return 'ESI/1.0' in capability
+
+    def _prefetchElements(self):
+        """Dereferences the elements of all slots in one batch.
+        """
+        elements = []
+        for slot in self.filled_slots.objectValues():
+            elements.extend(slot.objectValues())
+        prefetchElements(self, elements)
+
+    def _isPublished(self):
+        """Returns true if this composite is the page being published.
+
+        Composites rendered as elements of another page leave the
+        response headers alone.
+        """
+        if self._v_editing:
+            return 0
+        req = getattr(self, "REQUEST", None)
+        if req is None or getattr(req, "RESPONSE", None) is None:
+            return 0
+        published = req.get('PUBLISHED', None)
+        published = getattr(published, 'im_self', published)
+        return published is not None and aq_base(published) is aq_base(self)
+
+    def _isAnonymous(self):
+        user = getSecurityManager().getUser()
+        return user is not None and user.getUserName() == 'Anonymous User'
+
+    def _getRenderPath(self):
+        """Returns what identifies a rendering of this composite.
+        """
+        req = getattr(self, "REQUEST", None)
+        if req is not None:
+            query = req.get('QUERY_STRING', '')
+        else:
+            query = ''
+        return ('/'.join(self.getPhysicalPath()), self.absolute_url(), query)
+
+    def _getRenderDeps(self, template):
+        """Returns the serials of everything the rendering depends on.
+
+        The dependencies change whenever the composite, its slots, its
+        elements, the objects they refer to, or the template change.
+        Templates read from files (see _getFileVersion) count by their
+        file's modification time.  Returns None if some of them are
+        not saved.
+
+        This is computed on every request, including cache hits, and
+        dereferences every element, so a hit still costs one load of
+        each element and its target, though no rendering.
+        """
+        obs = []
+        try:
+            self._collectRenderInputs(template, obs, {})
+        except ConflictError:
+            raise
+        except:
+            # Let the normal rendering report broken elements.
+            return None
+        deps = []
+        for ob in obs:
+            serial = getSerial(ob)
+            if serial is None:
+                serial = _getFileVersion(ob)
+                if serial is None:
+                    return None
+            deps.append(serial)
+        return tuple(deps)
+
+    def _setCachePolicy(self, ttl):
+        """Sets the caching headers of the published page.
+
+        The page may be cached publicly for ttl seconds (see
+        _getPageTTL), unless some elements timed out.  Otherwise it is
+        private.  A Cache-Control header set by the template is kept.
+        """
+        response = self.REQUEST.RESPONSE
+        if response.getHeader('Cache-Control'):
+            return
+        if ttl and not self._v_timed_out:
+            response.setHeader('Cache-Control', 'public, max-age=%d' % ttl)
+            response.setHeader('Expires', rfc1123_date(time() + ttl))
+        else:
+            response.setHeader('Cache-Control', 'private, no-cache')
+
+    def _getPageTTL(self, template, esi=0, seen=None):
+        """Returns how long the page may be cached publicly.
+
+        That is the shortest cache lifetime of the page's elements.
+        With Edge Side Includes, the proxy caches the elements
+        separately, so the page around them gets the composite's
+        esi_shell_ttl instead.  Elements that refer to other
+        composites count with the elements of those composites.
+        Returns 0 if the page must not be cached, or None if the page
+        has no elements.
+        """
+        if seen is None:
+            seen = {}
+        seen[id(aq_base(self))] = 1
+        res = None
+        if esi:
+            res = self.esi_shell_ttl
+            if not res:
+                return 0
+        specs = findSlotSpecs(template)
+        class_names = None
+        if specs is not None:
+            class_names = {}
+            for spec in specs:
+                class_names.setdefault(spec['name'], spec['class_name'])
+        for slot in self.filled_slots.objectValues():
+            class_name = None
+            if class_names is not None:
+                if not class_names.has_key(slot.getId()):
+                    # Not shown by the template.
+                    continue
+                class_name = class_names[slot.getId()]
+            for element in slot.objectValues():
+                if esi and hasattr(aq_base(element), 'renderFragment'):
+                    # Included, not part of the page.
+                    continue
+                if not ICompositeElement.providedBy(element):
+                    return 0
+                get_ttl = getattr(element, 'getCacheTTL', None)
+                if get_ttl is None:
+                    return 0
+                ttl = get_ttl(class_name)
+                if not ttl:
+                    return 0
+                try:
+                    target = element.dereference()
+                    inner = None
+                    if (IComposite.providedBy(target)
+                        and not seen.has_key(id(aq_base(target)))):
+                        inner = target._getPageTTL(
+                            target.getTemplate(), target._acceptsESI(), seen)
+                except ConflictError:
+                    raise
+                except:
+                    # Broken elements are not cached.
+                    return 0
+                if inner is not None and inner < ttl:
+                    ttl = inner
+                    if not ttl:
+                        return 0
+                if res is None or ttl < res:
+                    res = ttl
+        return res
+
+    def _collectRenderInputs(self, template, obs, seen):
+        """Lists the objects that contribute to the rendering.
+
+        Follows elements that refer to other composites.
+        """
+        seen[id(aq_base(self))] = 1
+        obs.extend((template, self, self.filled_slots))
+        for slot in self.filled_slots.objectValues():
+            obs.append(slot)
+            for element in slot.objectValues():
+                obs.append(element)
+                if not ICompositeElement.providedBy(element):
+                    continue
+                target = element.dereference()
+                obs.append(target)
+                if (IComposite.providedBy(target)
+                    and not seen.has_key(id(aq_base(target)))):
+                    target._collectRenderInputs(
+                        target.getTemplate(), obs, seen)
+
     index_html = None
 
     security.declareProtected(change_composites_perm, "design")
-    def design(self, ui=None):
+    def design(self, ui=None, stream=0):
         """Renders the composite with editing features.
+
+        If stream is true, the page is written to the response as it
+        is produced and an empty string is returned.  The template is
+        rendered first, with a marker in place of each element, so the
+        top of the page goes out before any element is rendered.  Each
+        element is rendered when the response reaches its marker.
         """
         # Never cache a design view.
         req = getattr(self, "REQUEST", None)
@@ -158,9 +469,48 @@ class CompositeMixin:
         ui_obj = self.getUI(ui)
         self._v_editing = 1
         try:
+            if stream and req is not None:
+                self._v_deferred = {}
+                self._writeChunks(ui_obj.renderChunks(self), req["RESPONSE"])
+                return ''
             return ui_obj.render(self)
         finally:
             self._v_editing = 0
+            self._v_deferred = None
+
+    def _writeChunks(self, chunks, response):
+        """Writes rendered chunks to a response.
+
+        Renders the deferred elements found in the chunks.
+        """
+        charset = 'utf-8'
+        content_type = response.getHeader('Content-Type')
+        if content_type:
+            match = charset_search(content_type)
+            if match is not None:
+                charset = match.group(1)
+        else:
+            response.setHeader('Content-Type', 'text/html; charset=%s' % charset)
+        for chunk in chunks:
+            if self._v_deferred and chunk:
+                parts = deferred_split(chunk)
+            else:
+                parts = (chunk,)
+            for part in parts:
+                if self._v_deferred and self._v_deferred.has_key(part):
+                    part = self._renderDeferred(part)
+                if not part:
+                    continue
+                if isinstance(part, unicode):
+                    part = part.encode(charset)
+                response.write(part)
+
+    def _renderDeferred(self, marker):
+        """Renders an element deferred by Slot._deferElements().
+        """
+        slot, item, class_name = self._v_deferred[marker]
+        slot._v_class_name = class_name
+        return slot._renderElements([item], self.isEditing(), self)[0]
 
     security.declareProtected(change_composites_perm, "manage_designForm")
     def manage_designForm(self):
@@ -201,6 +551,48 @@ class CompositeMixin:
 
         Returns [{'name', 'class_name', 'title'}].  May return duplicates.
         """
+        return list(self._getSlotSpecInfo()[0])
+
+    security.declareProtected(change_composites_perm, "getSlotSpecIndex")
+    def getSlotSpecIndex(self):
+        """Returns the slot specs within the template, indexed by name.
+
+        Returns {name: (class_name, title)}.  When the template uses a
+        slot more than once, the first use wins.
+        """
+        return self._getSlotSpecInfo()[1]
+
+    def _getSlotSpecInfo(self):
+        """Returns (specs, index), computed once per request.
+
+        The result is kept in the request until the template changes.
+        """
+        template = self.getTemplate()
+        req = getattr(self, "REQUEST", None)
+        memo = getattr(req, "other", None)
+        key = ('composite_slot_specs', '/'.join(self.getPhysicalPath()))
+        if memo is not None:
+            cached = memo.get(key)
+            if (cached is not None and cached[0] is getattr(
+                aq_base(template), '_v_program', None)):
+                return cached[1]
+        specs = self._findSlotSpecs(template)
+        index = {}
+        for spec in specs:
+            if not index.has_key(spec['name']):
+                index[spec['name']] = (spec['class_name'], spec['title'])
+        info = (specs, index)
+        if memo is not None:
+            memo[key] = (getattr(aq_base(template), '_v_program', None), info)
+        return info
+
+    def _findSlotSpecs(self, template):
+        specs = findSlotSpecs(template)
+        if specs is not None:
+            self._persistSlots(specs)
+            return specs
+        # The template finds slots some other way, so render it to
+        # learn what slots it uses.
         self._v_editing = 1
         self._v_slot_specs = []
         try:
@@ -211,6 +603,20 @@ class CompositeMixin:
             self._v_editing = 0
             self._v_slot_specs = None
 
+    def _persistSlots(self, specs):
+        """Stores the slots named in specs that don't exist yet.
+
+        Rendering in editing mode stores the slots the template uses,
+        so that elements can be added to them.  Specs found without
+        rendering need the same.
+        """
+        slots = self.filled_slots
+        slot_class = self.slots._slot_class
+        for spec in specs:
+            name = str(spec['name'])
+            if not slots.hasObject(name):
+                slots._setObject(name, slot_class(name))
+
     security.declareProtected(change_composites_perm, "getSlotClassName")
     def getSlotClassName(self, slot_name):
         """Returns the class_name of a slot.
@@ -218,11 +624,7 @@ class CompositeMixin:
         Returns None if no class is defined for the slot.  Raises
         KeyError if no such slot exists.
         """
-        specs = self.getSlotSpecs()
-        for spec in specs:
-            if spec['name'] == slot_name:
-                return spec['class_name']
-        raise KeyError(slot_name)
+        return self.getSlotSpecIndex()[slot_name][0]
 
     security.declareProtected(change_composites_perm, "getManifest")
     def getManifest(self):
@@ -234,6 +636,7 @@ class CompositeMixin:
         contents = []  # [{name, slot_info}]
         seen = {}
         specs = self.getSlotSpecs()
+        self._prefetchElements()
         if hasattr(self, 'portal_url'):
             icon_base_url = self.portal_url()
         else:
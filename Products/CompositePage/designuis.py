@@ -24,11 +24,16 @@ from Acquisition import aq_base, aq_inner, aq_parent
 from OFS.SimpleItem import SimpleItem
 from Products.PageTemplates.PageTemplateFile import PageTemplateFile
 from AccessControl import ClassSecurityInfo
+from AccessControl import getSecurityManager
 from AccessControl.ZopeGuards import guarded_getattr
 
+from Products.CompositePage.cache import LRUCache
 from Products.CompositePage.rawfile import RawFile
 from Products.CompositePage.rawfile import InterpolatedFile
+from Products.CompositePage.rawfile import BundleFile
+from Products.CompositePage.interfaces import IComposite
 from Products.CompositePage.interfaces import ICompositeElement
+from Products.CompositePage.interfaces import CompositeError
 
 
 _common = os.path.join(os.path.dirname(__file__), "common")
@@ -36,9 +41,7 @@ _zmi = os.path.join(os.path.dirname(__file__), "zmi")
 _cmf = os.path.join(os.path.dirname(__file__), "cmf")
 _manual = os.path.join(os.path.dirname(__file__), "manual")
 
-start_of_head_search = re.compile("(<head[^>]*>)", re.IGNORECASE).search
-start_of_body_search = re.compile("(<body[^>]*>)", re.IGNORECASE).search
-end_of_body_search = re.compile("(</body[^>]*>)", re.IGNORECASE).search
+start_tag_finditer = re.compile("<(head|body)[^>]*>", re.IGNORECASE).finditer
 
 default_html_page = """<html>
 <head>
@@ -50,6 +53,16 @@ default_html_page = """<html>
 </html>
 """
 
+# Rendered design fragments: see CommonUI._getFragmentsCacheKey
+_design_fragment_cache = LRUCache(200)
+
+try:
+    from zope.testing.cleanup import addCleanUp
+except ImportError:
+    pass
+else:
+    addCleanUp(_design_fragment_cache.clear)
+
 close_dialog_html = '''<html>
 <script type="text/javascript">
 if (window.opener)
@@ -59,6 +72,39 @@ window.close();
 </html>
 '''
 
+def findInsertionPoints(text):
+    """Finds where design fragments go in a page.
+
+    Returns the index just after the first head tag, the index just
+    after the first body tag, and the index of the last body end tag.
+    Each is None if not found.  The start tags are found in one scan
+    from the beginning of the page and the end tag in one scan from
+    the end, so the bulk of the page is examined only once.
+    """
+    head_index = None
+    top_index = None
+    for match in start_tag_finditer(text):
+        if match.group(1).lower() == 'head':
+            if head_index is None:
+                head_index = match.end(0)
+        elif top_index is None:
+            top_index = match.end(0)
+        if head_index is not None and top_index is not None:
+            break
+    bottom_index = None
+    end = len(text)
+    while end > 0:
+        index = text.rfind('</', 0, end)
+        if index < 0:
+            break
+        if (text[index + 2:index + 6].lower() == 'body'
+            and text.find('>', index + 6) >= 0):
+            bottom_index = index
+            break
+        end = index
+    return head_index, top_index, bottom_index
+
+
 class CommonUI(SimpleItem):
     """Basic page design UI.
 
@@ -77,70 +123,149 @@ class CommonUI(SimpleItem):
     target_image_hover = RawFile("target_hover.gif", "image/gif", _common)
     target_image_active = RawFile("target_active.gif", "image/gif", _common)
     element_image = RawFile("element.gif", "image/gif", _common)
+    design_js = BundleFile(("pdlib_js", "edit_js"), "text/javascript")
+    designstyles_css = BundleFile(
+        ("pdstyles_css", "editstyles_css"), "text/css")
+
+    # If true, the header templates link to design_js and
+    # designstyles_css instead of the individual files.
+    use_bundles = 1
 
     header_templates = (PageTemplateFile("header.pt", _common),)
     top_templates = ()
     bottom_templates = (PageTemplateFile("bottom.pt", _common),)
 
+    # Templates to render on every request rather than cache.
+    uncached_templates = ()
+
     changeTemplateForm = PageTemplateFile("changeTemplateForm.pt", _common)
 
     workspace_view_name = "view"  # To be overridden
 
+    security.declarePublic("getAssetURL")
+    def getAssetURL(self, name):
+        """Returns the fingerprinted URL of a file held by this UI.
+
+        The URL changes whenever the file changes, so browsers may
+        cache the file for a long time.
+        """
+        f = getattr(self, name)
+        return "%s/%s/%s" % (self.absolute_url(), name, f.fingerprint())
+
     security.declarePublic("getFragments")
     def getFragments(self, composite):
         """Returns the fragments to be inserted in design mode.
+
+        The fragments are cached until the URLs, the user's roles,
+        the clipboard state, or the templates change.  The templates
+        in uncached_templates depend on more of the request than that,
+        so they are rendered every time.
         """
-        params = {
-            "tool": aq_parent(aq_inner(aq_parent(aq_inner(self)))),
+        tool = aq_parent(aq_inner(aq_parent(aq_inner(self))))
+        key = self._getFragmentsCacheKey(tool, composite)
+        parts = _design_fragment_cache.get(key)
+        if parts is None:
+            parts = self._renderFragments(tool, composite)
+            _design_fragment_cache.set(key, parts)
+        params = None
+        fragments = {}
+        for name, items in parts.items():
+            text = ""
+            for item in items:
+                if not isinstance(item, basestring):
+                    if params is None:
+                        params = self._getFragmentParams(tool, composite)
+                    item = item.__of__(self)(**params)
+                text += item
+            fragments[name] = text
+        return fragments
+
+    def _getFragmentsCacheKey(self, tool, composite):
+        templates = (self.header_templates + self.top_templates
+                     + self.bottom_templates)
+        versions = []
+        for t in templates:
+            # Reloads the template if it changed on disk in debug mode.
+            t._cook_check()
+            versions.append((id(t), t._v_last_read))
+        roles = list(getSecurityManager().getUser().getRolesInContext(
+            composite))
+        roles.sort()
+        req = getattr(self, "REQUEST", None)
+        # The bottom templates offer to paste if the clipboard is full.
+        clipboard = req is not None and not not req.get("__cp")
+        return (self.getId(), tool.absolute_url(), self.absolute_url(),
+                composite.absolute_url(), clipboard, tuple(roles),
+                tuple(versions))
+
+    def _getFragmentParams(self, tool, composite):
+        return {
+            "tool": tool,
             "ui": self,
             "composite": composite,
             }
-        header = ""
-        top = ""
-        bottom = ""
-        for t in self.header_templates:
-            header += t.__of__(self)(**params)
-        for t in self.top_templates:
-            top += t.__of__(self)(**params)
-        for t in self.bottom_templates:
-            bottom += t.__of__(self)(**params)
-        return {"header": header, "top": top, "bottom": bottom}
+
+    def _renderFragments(self, tool, composite):
+        """Returns {name: [text]} for the header, top and bottom.
+
+        The templates in uncached_templates are left in the lists
+        unrendered.
+        """
+        params = self._getFragmentParams(tool, composite)
+        uncached = [id(t) for t in self.uncached_templates]
+        res = {}
+        for name, templates in (("header", self.header_templates),
+                                ("top", self.top_templates),
+                                ("bottom", self.bottom_templates)):
+            items = []
+            for t in templates:
+                if id(t) not in uncached:
+                    t = t.__of__(self)(**params)
+                items.append(t)
+            res[name] = items
+        return res
 
 
     security.declarePrivate("render")
     def render(self, composite):
         """Renders a composite, adding scripts and styles.
         """
+        return ''.join(self.renderChunks(composite))
+
+
+    security.declarePrivate("renderChunks")
+    def renderChunks(self, composite):
+        """Renders a composite, adding scripts and styles.
+
+        Returns a sequence of strings.  The fragments are yielded
+        between slices of the rendered composite rather than spliced
+        into it, so the page is never copied as a whole.
+        """
         text = composite()
         fragments = self.getFragments(composite)
-        match = start_of_head_search(text)
-        if match is None:
+        head_index, top_index, bottom_index = findInsertionPoints(text)
+        if head_index is None:
             # Turn it into a page.
             text = default_html_page % text
-            match = start_of_head_search(text)
-            if match is None:
+            head_index, top_index, bottom_index = findInsertionPoints(text)
+            if head_index is None:
                 raise CompositeError("Could not find header")
-        if fragments['header']:
-            index = match.end(0)
-            text = "%s%s%s" % (text[:index], fragments['header'], text[index:])
-        if fragments['top']:
-            match = start_of_body_search(text)
-            if match is None:
-                raise CompositeError("No 'body' tag found")
-            index = match.end(0)
-            text = "%s%s%s" % (text[:index], fragments['top'], text[index:])
-        if fragments['bottom']:
-            match = end_of_body_search(text)
-            if match is None:
-                raise CompositeError("No 'body' end tag found")
-            m = match
-            while m is not None:
-                # Find the *last* occurrence of "</body>".
-                match = m
-                m = end_of_body_search(text, match.end(0))
-            index = match.start(0)
-            text = "%s%s%s" % (text[:index], fragments['bottom'], text[index:])
-        return text
+        if fragments['top'] and top_index is None:
+            raise CompositeError("No 'body' tag found")
+        if fragments['bottom'] and bottom_index is None:
+            raise CompositeError("No 'body' end tag found")
+        insertions = [(head_index, 0, fragments['header']),
+                      (top_index, 1, fragments['top']),
+                      (bottom_index, 2, fragments['bottom'])]
+        insertions.sort()
+        pos = 0
+        for index, order, fragment in insertions:
+            if index is None or not fragment:
+                continue
+            yield text[pos:index]
+            yield fragment
+            pos = index
+        yield text[pos:]
 
 
     security.declarePublic("showElement")
@@ -257,11 +382,16 @@ class ZMIUI (CommonUI):
 
     security.declarePublic("zmi_edit_js")
     zmi_edit_js = RawFile("zmi_edit.js", "text/javascript", _zmi)
+    design_js = BundleFile(
+        ("pdlib_js", "edit_js", "zmi_edit_js"), "text/javascript")
 
     header_templates = CommonUI.header_templates + (
         PageTemplateFile("header.pt", _zmi),)
     top_templates = CommonUI.top_templates + (
         PageTemplateFile("top.pt", _zmi),)
+    # The management tabs depend on the URL, the management view and
+    # the user's permissions.
+    uncached_templates = top_templates
     bottom_templates = (PageTemplateFile("bottom.pt", _zmi),
                         ) + CommonUI.bottom_templates
 
@@ -280,6 +410,8 @@ class CMFUI (CommonUI):
 
     security.declarePublic("cmf_edit_js")
     cmf_edit_js = RawFile("cmf_edit.js", "text/javascript", _cmf)
+    design_js = BundleFile(
+        ("pdlib_js", "edit_js", "cmf_edit_js"), "text/javascript")
 
     header_templates = CommonUI.header_templates + (
         PageTemplateFile("header.pt", _cmf),)
@@ -302,6 +434,10 @@ class ManualUI (CommonUI):
     bottom_templates = CommonUI.bottom_templates + (
         PageTemplateFile("bottom.pt", _manual),)
     manual_js = RawFile("manual.js", "text/javascript", _manual)
+    design_js = BundleFile(
+        ("pdlib_js", "edit_js", "manual_js"), "text/javascript")
+    designstyles_css = BundleFile(
+        ("pdstyles_css", "manual_styles_css"), "text/css")
     add_icon = RawFile("add.gif", "image/gif", _manual)
     add_rollover = RawFile("add_rollover.gif", "image/gif", _manual)
     remove_icon = RawFile("remove.gif", "image/gif", _manual)
@@ -312,6 +448,8 @@ class ManualUI (CommonUI):
     copy_rollover = RawFile("copy_rollover.gif", "image/gif", _manual)
     paste_icon = RawFile("paste.gif", "image/gif", _manual)
     paste_rollover = RawFile("paste_rollover.gif", "image/gif", _manual)
+    # Built from the icons above by manual/make_sprite.py.
+    icons_png = RawFile("icons.png", "image/png", _manual)
 
     security.declarePublic("renderBody")
     def renderBody(self, composite):
@@ -330,6 +468,12 @@ class ManualUI (CommonUI):
 
         Returns a full HTML page with scripts and styles.
         """
+        return ''.join(self.renderChunks(composite))
+
+    security.declarePrivate("renderChunks")
+    def renderChunks(self, composite):
+        """Renders a ZMI slotting interface as a sequence of strings.
+        """
         fragments = self.getFragments(composite)
         body = self.renderBody(composite)
         res = []
@@ -340,6 +484,9 @@ class ManualUI (CommonUI):
         res.append(body)
         res.append(fragments["bottom"])
         res.append(composite.manage_page_footer())
-        return '\n'.join(res)
+        for chunk in res[:-1]:
+            yield chunk
+            yield '\n'
+        yield res[-1]
 
 Globals.InitializeClass(ManualUI)
@@ -16,28 +16,255 @@ $Id: element.py,v 1.5 2004/04/14 16:15:29 sidnei Exp $
 """
 
 import os
+from copy import deepcopy
 
 import Globals
+import transaction
+from AccessControl import getSecurityManager
 from AccessControl.SecurityInfo import ClassSecurityInfo
+from Acquisition import aq_base
 from Acquisition import aq_get
+from Acquisition import aq_inner
+from Acquisition import aq_parent
 from OFS.SimpleItem import SimpleItem
 from OFS.PropertyManager import PropertyManager
 from Products.PageTemplates.PageTemplateFile import PageTemplateFile
 from DocumentTemplate.DT_Util import safe_callable
+from ZODB.POSException import ConflictError
+from zExceptions import NotFound
+from zExceptions import Unauthorized
 
 from zope.interface import implements
 
 from Products.CompositePage.interfaces import ICompositeElement
+from Products.CompositePage.interfaces import ICopyableElement
+from Products.CompositePage.perm_names import view_perm
+from Products.CompositePage.parallel import getUserInfo
+from Products.CompositePage.slot import formatException
+from Products.CompositePage.cache import LRUCache
+from Products.CompositePage.utils import copyOf
+from Products.CompositePage.utils import getSerial
+from Products.CompositePage.utils import getUserKey
 
 _www = os.path.join(os.path.dirname(__file__), "www")
 
+_marker = []
+
+# Rendered elements:
+# (url, template name, serial, user id or None, roles) -> text
+_fragment_cache = LRUCache(1000)
+
+# Default inline templates:
+# (tool path, portal_type or class, slot class, template names) -> name
+_template_cache = LRUCache(1000)
+
+try:
+    from zope.testing.cleanup import addCleanUp
+except ImportError:
+    pass
+else:
+    addCleanUp(_fragment_cache.clear)
+    addCleanUp(_template_cache.clear)
+
+
+def _getSecurityKey():
+    """Returns what the security checks of traversal depend on.
+
+    That is the user, the owners of the executables (scripts and
+    templates) on the security manager's stack, and the proxy roles
+    of the topmost one, as ZopeSecurityPolicy applies them.
+    """
+    sm = getSecurityManager()
+    stack = getattr(getattr(sm, '_context', None), 'stack', None) or ()
+    owners = []
+    for executable in stack:
+        get_owner = getattr(executable, 'getOwnerTuple', None)
+        if get_owner is not None:
+            owner = get_owner()
+            if isinstance(owner, tuple):
+                # Unowned executables don't restrict access.
+                owners.append((tuple(owner[0]), owner[1]))
+    proxy_roles = None
+    if stack:
+        proxy_roles = getattr(stack[-1], '_proxy_roles', None)
+        if proxy_roles:
+            proxy_roles = tuple(proxy_roles)
+    return getUserInfo(sm.getUser()), tuple(owners), proxy_roles
+
+
+def getDereferenceCache(context):
+    """Returns the {absolute path: object} mapping for this request.
+
+    Returns None if there is no request.  Traversal applies security
+    checks, so there is a mapping per security context: the user, and
+    the owners and proxy roles of the executing scripts and templates.
+    """
+    req = getattr(context, "REQUEST", None)
+    memo = getattr(req, "other", None)
+    if memo is None:
+        return None
+    key = ('composite_dereference', _getSecurityKey())
+    cache = memo.get(key)
+    if cache is None:
+        cache = memo[key] = {}
+    return cache
+
+
+def resolvePaths(context, paths):
+    """Traverses many absolute paths at once.
+
+    Paths that share a prefix share the traversal (and the security
+    checks) of that prefix.  Returns {path: object}.  Paths that can
+    not be traversed are left out, so that the caller can report the
+    error by traversing again.
+    """
+    tree = {}
+    for path in paths:
+        if not path.startswith('/'):
+            continue
+        node = tree
+        for name in path.split('/')[1:]:
+            if name:
+                node = node.setdefault(name, {})
+        node.setdefault(None, []).append(path)
+    res = {}
+    _resolveTree(context.getPhysicalRoot(), tree, res)
+    return res
+
+
+def _resolveTree(ob, node, res):
+    for name, child in node.items():
+        if name is None:
+            for path in child:
+                res[path] = ob
+            continue
+        try:
+            next = ob.restrictedTraverse(name)
+        except ConflictError:
+            raise
+        except:
+            continue
+        _resolveTree(next, child, res)
+
+
+def prefetchElements(context, elements):
+    """Dereferences many elements with one batch of traversals.
+
+    The results go into the dereference cache of the request.
+    """
+    cache = getDereferenceCache(context)
+    if cache is None:
+        return
+    paths = []
+    for element in elements:
+        base = aq_base(element)
+        path = getattr(base, 'path', None)
+        if getattr(base, '_target_oids', None) and base.resolve_by_oid:
+            # Found without traversal.
+            continue
+        if (ICompositeElement.providedBy(element) and path
+            and not cache.has_key(path)):
+            paths.append(path)
+    if paths:
+        cache.update(resolvePaths(context, paths))
+
+
+def _getTargetOids(ob, path):
+    """Returns ((name, oid),) from the root to ob, or None.
+
+    Returns None unless the path maps one-to-one onto stored objects
+    in their containers, since acquisition can not be replayed.
+    """
+    root = aq_base(ob.getPhysicalRoot())
+    oids = []
+    while ob is not None and aq_base(ob) is not root:
+        oid = getattr(aq_base(ob), '_p_oid', None)
+        if oid is None:
+            # Not stored yet, or not a persistent object.
+            return None
+        oids.append((ob.getId(), oid))
+        ob = aq_parent(aq_inner(ob))
+    oids.reverse()
+    names = [name for name in path.split('/') if name]
+    if names != [name for name, oid in oids]:
+        # The path relies on acquisition.
+        return None
+    return tuple(oids)
+
+
+def _repairTargetOids(status, db, oid, oids):
+    """Records new target OIDs on an element, in a transaction of its own.
+
+    Scheduled by CompositeElement.dereference() to run after the
+    rendering transaction commits, so that rendering never writes.  A
+    conflict just leaves the repair to a later rendering.
+    """
+    if not status:
+        return
+    tm = transaction.TransactionManager()
+    conn = db.open(transaction_manager=tm)
+    try:
+        try:
+            element = conn.get(oid)
+            if element._target_oids != oids:
+                element._target_oids = oids
+                tm.commit()
+        except ConflictError:
+            pass
+    finally:
+        tm.abort()
+        conn.close()
+
+
+# Types that copyElement() copies without pickling.
+_plain_types = (type(None), bool, int, long, float, str, unicode)
+_plain_containers = (tuple, list, dict)
+
+
+def _isPlain(value, limit=1000):
+    """Returns true if value holds nothing but plain immutables.
+
+    Tuples, lists and dicts of them are allowed as long as they hold
+    no more than limit values in all.  Types are compared exactly,
+    since subclasses of builtins may carry any kind of state.
+    """
+    stack = [value]
+    while stack:
+        value = stack.pop()
+        t = type(value)
+        if t in _plain_types:
+            continue
+        if t not in _plain_containers:
+            return False
+        limit -= len(value)
+        if limit < 0:
+            return False
+        if t is dict:
+            stack.extend(value.keys())
+            stack.extend(value.values())
+        else:
+            stack.extend(value)
+    return True
+
+
+def _findTemplate(obj, name):
+    """Returns a template for an object, or None if it has no such name.
+
+    Unauthorized errors propagate, so that the result does not depend
+    on the user.
+    """
+    try:
+        return obj.restrictedTraverse(str(name))
+    except (AttributeError, KeyError, NotFound):
+        return None
+
 
 class CompositeElement(SimpleItem, PropertyManager):
     """A simple path-based reference to an object and a template.
 
     You can render it and choose which template to apply for rendering.
     """
-    implements(ICompositeElement)
+    implements(ICompositeElement, ICopyableElement)
     meta_type = "Composite Element"
     security = ClassSecurityInfo()
     manage_options = PropertyManager.manage_options + SimpleItem.manage_options
@@ -45,18 +272,146 @@ class CompositeElement(SimpleItem, PropertyManager):
     _properties = (
         {'id': 'path', 'type': 'string', 'mode': 'w',},
         {'id': 'template_name', 'type': 'string', 'mode': 'w',},
+        {'id': 'cache_ttl', 'type': 'int', 'mode': 'w',
+         'label': 'Seconds to cache the rendering (0 = use slot class)',},
+        {'id': 'resolve_by_oid', 'type': 'boolean', 'mode': 'w',
+         'label': 'Find the target by database OID before the path',},
+        {'id': 'render_concurrently', 'type': 'boolean', 'mode': 'w',
+         'label': 'Render in a separate thread (or as the slot class says)',},
+        {'id': 'render_timeout', 'type': 'float', 'mode': 'w',
+         'label': 'Seconds to wait for the rendering (0 = use the tool)',},
         )
 
     template_name = ''
+    cache_ttl = 0
+    resolve_by_oid = 0
+    render_concurrently = 0
+    render_timeout = 0.0
+    _target_oids = None  # ((name, oid),) from the root to the target
+    _v_oid_repair = None  # (OIDs,) scheduled to be recorded
 
     def __init__(self, id, obj):
         self.id = id
         self.path = '/'.join(obj.getPhysicalPath())
+        self._target_oids = _getTargetOids(obj, self.path)
+
+    def _updateProperty(self, id, value):
+        PropertyManager._updateProperty(self, id, value)
+        if id in ('path', 'resolve_by_oid'):
+            self._recordTargetOids()
+
+    def _recordTargetOids(self):
+        """Remembers the OIDs of the target and its containers.
+
+        Called when the path is edited, never while rendering.
+        Security is checked when the OIDs are used.
+        """
+        oids = None
+        if self.path.startswith('/'):
+            try:
+                ob = self.unrestrictedTraverse(self.path)
+            except (AttributeError, KeyError, NotFound):
+                ob = None
+            if ob is not None:
+                oids = _getTargetOids(ob, self.path)
+        self._target_oids = oids
 
     def dereference(self):
         """Returns the object referenced by this composite element.
+
+        Absolute paths are traversed at most once per request.
+        """
+        path = self.path
+        if not path.startswith('/'):
+            return self.restrictedTraverse(path)
+        cache = getDereferenceCache(self)
+        if cache is not None:
+            ob = cache.get(path)
+            if ob is not None:
+                return ob
+        if self.resolve_by_oid:
+            ob = self._resolveOids()
+            if ob is None:
+                ob = self.restrictedTraverse(path)
+                self._scheduleOidRepair(ob)
+        else:
+            ob = self.restrictedTraverse(path)
+        if cache is not None:
+            cache[path] = ob
+        return ob
+
+    def _resolveOids(self):
+        """Returns the target using the stored OIDs.
+
+        Gets the target and its containers from the ZODB connection by
+        OID.  Each is checked to still be held by the one before it,
+        since a moved container would otherwise lend the target a
+        stale security context.  Access is checked at each step, as
+        restrictedTraverse() does.  Returns None if the objects no
+        longer match the path.
+        """
+        oids = self._target_oids
+        jar = self._p_jar
+        if not oids or jar is None:
+            return None
+        names = [name for name in self.path.split('/') if name]
+        if names != [name for name, oid in oids]:
+            # The path was changed without _updateProperty().
+            return None
+        validate = getSecurityManager().validate
+        ob = self.getPhysicalRoot()
+        for name, oid in oids:
+            try:
+                found = jar.get(oid)
+            except KeyError:
+                # Deleted and packed away.
+                return None
+            container = aq_base(ob)
+            if hasattr(container, '_getOb'):
+                held = container._getOb(name, None)
+            else:
+                held = getattr(container, name, None)
+            if aq_base(held) is not found or not hasattr(found, '__of__'):
+                # Moved, renamed or replaced.
+                return None
+            next = found.__of__(ob)
+            if not validate(ob, ob, name, next):
+                raise Unauthorized(name)
+            ob = next
+        return ob
+
+    def _scheduleOidRepair(self, ob):
+        """Arranges to record the OIDs of a target found by its path.
+
+        The OIDs are written after the current transaction commits,
+        in a transaction of their own, so that later renderings find
+        the target by OID again.  If the path relies on acquisition,
+        the stale OIDs are cleared instead, so that only the path is
+        tried.
+        """
+        oids = _getTargetOids(ob, self.path)
+        jar = self._p_jar
+        if (oids == self._target_oids or jar is None
+            or self._v_oid_repair == (oids,)):
+            return
+        self._v_oid_repair = (oids,)
+        transaction.get().addAfterCommitHook(
+            _repairTargetOids, (jar.db(), self._p_oid, oids))
+
+    def copyElement(self):
+        """Returns an unattached copy of this element.
+
+        The element holds only a path and some settings, so its state
+        is copied directly instead of being pickled.  Elements whose
+        state holds anything else, such as the persistent or custom
+        objects of a subclass, are pickled.
         """
-        return self.restrictedTraverse(self.path)
+        state = self.__getstate__()
+        if not _isPlain(state):
+            return copyOf(self)
+        ob = self.__class__.__new__(self.__class__)
+        ob.__setstate__(deepcopy(state))
+        return ob
 
     def renderInline(self):
         """Returns a representation of this object as a string.
@@ -64,10 +419,66 @@ class CompositeElement(SimpleItem, PropertyManager):
         obj = self.dereference()
         name = self.template_name
         if not name:
-            # Default to the first allowable inline template.
-            names = self.listAllowableInlineTemplates()
-            if names:
-                name = names[0]
+            name = self._getDefaultTemplateName(obj)
+        ttl = self.getCacheTTL()
+        if ttl:
+            serial = getSerial(obj)
+            if serial is not None:
+                # Elements that share a target and template share the
+                # cached text, regardless of the slot they are in.
+                # Logged-in users get their own entries.
+                key = (obj.absolute_url(), name, serial) + getUserKey(obj)
+                text = _fragment_cache.get(key)
+                if text is None:
+                    text = self._render(obj, name)
+                    self._storeFragment(key, text, ttl)
+                return text
+        return self._render(obj, name)
+
+    def _storeFragment(self, key, text, ttl):
+        """Adds a rendering to the fragment cache.
+
+        Entries are only added here, so this is where the tool's
+        fragment_cache_size is applied.
+        """
+        tool = aq_get(self, "composite_tool", None, 1)
+        if tool is not None:
+            _fragment_cache.max_entries = tool.fragment_cache_size
+        _fragment_cache.set(key, text, ttl)
+
+    security.declareProtected(view_perm, "renderFragment")
+    def renderFragment(self, class_name=None, REQUEST=None):
+        """Renders this element by itself, for Edge Side Includes.
+
+        The Cache-Control header follows the element's cache TTL.
+        """
+        slot = aq_parent(aq_inner(self))
+        tool = aq_get(self, "composite_tool", None, 1)
+        if (class_name and tool is not None
+            and tool.slot_classes._getOb(class_name, None) is not None):
+            slot._v_class_name = class_name
+        try:
+            text = self.renderInline()
+            ttl = self.getCacheTTL()
+        except ConflictError:
+            raise
+        except:
+            text = formatException(self, 0)
+            ttl = 0
+        if REQUEST is None:
+            REQUEST = getattr(self, 'REQUEST', None)
+        if REQUEST is not None:
+            user = getSecurityManager().getUser()
+            if ttl and user.getUserName() == 'Anonymous User':
+                cch = 'public, max-age=%d' % ttl
+            else:
+                cch = 'private, no-cache'
+            RESPONSE = REQUEST.RESPONSE
+            RESPONSE.setHeader('Content-Type', 'text/html')
+            RESPONSE.setHeader('Cache-Control', cch)
+        return text
+
+    def _render(self, obj, name):
         if name and name != "call":
             template = obj.restrictedTraverse(str(name))
             return template()
@@ -76,6 +487,46 @@ class CompositeElement(SimpleItem, PropertyManager):
             return obj()
         return unicode(obj)
 
+    def getCacheTTL(self, class_name=_marker):
+        """Returns the number of seconds the rendering may be cached.
+
+        Uses the cache_ttl of the slot class when the element does not
+        set its own.  class_name names that class; by default, it is
+        the class of the slot being rendered.  Returns 0 if the
+        rendering must not be cached.
+        """
+        if self.cache_ttl:
+            return self.cache_ttl
+        tool = aq_get(self, "composite_tool", None, 1)
+        if tool is None:
+            return 0
+        return getattr(self._getSlotClass(tool, class_name), 'cache_ttl', 0)
+
+    def shouldRenderConcurrently(self):
+        """Returns true if this element should render in its own thread.
+
+        Uses the render_concurrently flag of the slot class when the
+        element does not set its own.  Elements with a render_timeout
+        always render in their own thread, so that the page does not
+        have to wait for them.
+        """
+        if self.render_concurrently or self.render_timeout:
+            return 1
+        tool = aq_get(self, "composite_tool", None, 1)
+        if tool is None:
+            return 0
+        return getattr(self._getSlotClass(tool), 'render_concurrently', 0)
+
+    def _getSlotClass(self, tool, class_name=_marker):
+        """Returns the class of the slot being rendered, or None.
+        """
+        if class_name is _marker:
+            slot = aq_parent(aq_inner(self))
+            class_name = getattr(slot, '_v_class_name', None)
+        if not class_name:
+            return None
+        return tool.slot_classes._getOb(class_name, None)
+
     def queryInlineTemplate(self, slot_class_name=None):
         """Returns the name of the inline template this object uses.
         """
@@ -91,14 +542,44 @@ class CompositeElement(SimpleItem, PropertyManager):
         """
         tool = aq_get(self, "composite_tool", None, 1)
         if tool is not None:
+            obj = self.dereference()
             res = []
             for name in tool.default_inline_templates:
-                template = obj.restrictedTraverse(str(name))
-                res.append((name, template))
+                template = _findTemplate(obj, name)
+                if template is not None:
+                    res.append((name, template))
             return res
         # No tool found, so no inline templates are known.
         return ()
 
+    def _getDefaultTemplateName(self, obj):
+        """Returns the name of the first allowable inline template.
+
+        The choice depends on the kind of object, so it is cached by
+        portal_type or class.  Returns None if there is no choice.
+        """
+        tool = aq_get(self, "composite_tool", None, 1)
+        if tool is None:
+            return None
+        names = tuple(tool.default_inline_templates)
+        if not names:
+            return None
+        base = aq_base(obj)
+        slot = aq_parent(aq_inner(self))
+        key = ('/'.join(tool.getPhysicalPath()),
+               getattr(base, 'portal_type', None) or base.__class__,
+               getattr(slot, '_v_class_name', None),
+               names)
+        res = _template_cache.get(key, _marker)
+        if res is _marker:
+            res = None
+            for name in names:
+                if _findTemplate(obj, name) is not None:
+                    res = name
+                    break
+            _template_cache.set(key, res)
+        return res
+
 Globals.InitializeClass(CompositeElement)
 
 
@@ -24,6 +24,11 @@ class CompositeError(Exception):
     """
 
 
+class RenderTimeoutError(CompositeError):
+    """A page element took longer to render than allowed
+    """
+
+
 class IComposite(Interface):
     """An object whose rendering is composed of a layout and elements.
     """
@@ -125,3 +130,16 @@ class ICompositeElement(Interface):
     def dereference():
         """Returns the object to be rendered.
         """
+
+
+class ICopyableElement(Interface):
+    """A composite element that can copy itself cheaply.
+    """
+
+    def copyElement():
+        """Returns an unattached copy of this element.
+
+        The copy must not share mutable or persistent state with the
+        original.  Elements without this method are copied by
+        pickling.
+        """
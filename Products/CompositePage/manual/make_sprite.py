@@ -0,0 +1,274 @@
+##############################################################################
+#
+# Copyright (c) 2011 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.0 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Builds icons.png, the sprite of the manual UI icons.
+
+Stacks the icon GIFs in this directory into one PNG and writes the
+matching background positions into manual_styles.css.  Run it after
+changing an icon:
+
+  python make_sprite.py
+
+It has its own GIF decoder and PNG encoder, so no imaging library is
+needed.
+
+$Id$
+"""
+
+import os
+import struct
+import sys
+import zlib
+
+_here = os.path.dirname(os.path.abspath(__file__))
+
+# The images of the sprite, in order, and the CSS rule for each.
+IMAGES = (
+    ('add.gif', 'a.manual_add'),
+    ('add_rollover.gif', 'a.manual_add:hover'),
+    ('remove.gif', 'a.manual_remove'),
+    ('remove_rollover.gif', 'a.manual_remove:hover'),
+    ('cut.gif', 'a.manual_cut'),
+    ('cut_rollover.gif', 'a.manual_cut:hover'),
+    ('copy.gif', 'a.manual_copy'),
+    ('copy_rollover.gif', 'a.manual_copy:hover'),
+    ('paste.gif', 'a.manual_paste'),
+    ('paste_rollover.gif', 'a.manual_paste:hover'),
+    )
+
+# The generated rules go between these lines of manual_styles.css.
+BEGIN = '/* Sprite positions, written by make_sprite.py */\n'
+END = '/* End of sprite positions */\n'
+
+
+class ImageError(Exception):
+    """Unsupported or corrupt image data"""
+
+
+def _lzwDecode(data, min_code_size, pixel_count):
+    """Decodes GIF LZW data into a list of color indexes.
+    """
+    clear_code = 1 << min_code_size
+    end_code = clear_code + 1
+    res = []
+    table = None
+    code_size = min_code_size + 1
+    prev = None
+    bits = 0
+    nbits = 0
+    for byte in data:
+        bits |= ord(byte) << nbits
+        nbits += 8
+        while nbits >= code_size:
+            code = bits & ((1 << code_size) - 1)
+            bits >>= code_size
+            nbits -= code_size
+            if code == clear_code:
+                table = [[i] for i in range(clear_code)] + [None, None]
+                code_size = min_code_size + 1
+                prev = None
+                continue
+            if code == end_code or table is None:
+                return res[:pixel_count]
+            if code < len(table):
+                entry = table[code]
+                if prev is not None:
+                    table.append(prev + entry[:1])
+            elif code == len(table) and prev is not None:
+                entry = prev + prev[:1]
+                table.append(entry)
+            else:
+                raise ImageError("Bad LZW code")
+            res.extend(entry)
+            prev = entry
+            if len(table) == (1 << code_size) and code_size < 12:
+                code_size += 1
+    return res[:pixel_count]
+
+
+def _readSubBlocks(data, pos):
+    """Returns (joined sub-block data, position after the terminator).
+    """
+    chunks = []
+    while 1:
+        size = ord(data[pos])
+        pos += 1
+        if not size:
+            return ''.join(chunks), pos
+        chunks.append(data[pos:pos + size])
+        pos += size
+
+
+def _readColorTable(data, pos, flags):
+    size = 3 << ((flags & 7) + 1)
+    table = data[pos:pos + size]
+    colors = [table[i:i + 3] for i in range(0, size, 3)]
+    return colors, pos + size
+
+
+def decodeGIF(data):
+    """Decodes the first frame of a GIF image.
+
+    Returns (width, height, rows), where each row is a string of
+    RGBA pixels.
+    """
+    if data[:6] not in ('GIF87a', 'GIF89a'):
+        raise ImageError("Not a GIF image")
+    width, height, flags = struct.unpack('<HHB', data[6:11])
+    pos = 13
+    global_colors = None
+    if flags & 0x80:
+        global_colors, pos = _readColorTable(data, pos, flags)
+    transparent = None
+    while pos < len(data):
+        block = data[pos]
+        pos += 1
+        if block == '!':
+            label = data[pos]
+            ext, pos = _readSubBlocks(data, pos + 1)
+            if label == '\xf9' and len(ext) >= 4 and ord(ext[0]) & 1:
+                transparent = ord(ext[3])
+        elif block == ',':
+            left, top, w, h, flags = struct.unpack(
+                '<HHHHB', data[pos:pos + 9])
+            pos += 9
+            colors = global_colors
+            if flags & 0x80:
+                colors, pos = _readColorTable(data, pos, flags)
+            if colors is None:
+                raise ImageError("No color table")
+            min_code_size = ord(data[pos])
+            lzw, pos = _readSubBlocks(data, pos + 1)
+            indexes = _lzwDecode(lzw, min_code_size, w * h)
+            indexes.extend([0] * (w * h - len(indexes)))
+            if flags & 0x40:
+                order = _interlacedRows(h)
+            else:
+                order = range(h)
+            frame = [None] * h
+            for i in range(h):
+                frame[order[i]] = indexes[i * w:(i + 1) * w]
+            return _compose(width, height, left, top, w, frame, colors,
+                            transparent)
+        elif block == ';':
+            break
+        else:
+            raise ImageError("Unknown GIF block")
+    raise ImageError("No image in GIF")
+
+
+def _interlacedRows(height):
+    rows = []
+    for start, step in ((0, 8), (4, 8), (2, 4), (1, 2)):
+        rows.extend(range(start, height, step))
+    return rows
+
+
+def _compose(width, height, left, top, w, frame, colors, transparent):
+    clear = '\0\0\0\0'
+    rgba = []
+    for i, color in enumerate(colors):
+        if i == transparent:
+            rgba.append(clear)
+        else:
+            rgba.append(color + '\xff')
+    rows = []
+    for y in range(height):
+        fy = y - top
+        if fy < 0 or fy >= len(frame):
+            rows.append(clear * width)
+            continue
+        pixels = [rgba[i] for i in frame[fy][:width - left]]
+        row = clear * left + ''.join(pixels)
+        rows.append(row + clear * (width - len(row) // 4))
+    return width, height, rows
+
+
+def _chunk(kind, data):
+    crc = zlib.crc32(kind + data) & 0xffffffff
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', crc)
+
+
+def encodePNG(width, height, rows):
+    """Encodes RGBA rows as a PNG image.
+    """
+    raw = ''.join(['\0' + row for row in rows])
+    return ''.join([
+        '\x89PNG\r\n\x1a\n',
+        _chunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)),
+        _chunk('IDAT', zlib.compress(raw, 9)),
+        _chunk('IEND', ''),
+        ])
+
+
+def buildSprite(images):
+    """Stacks images vertically.
+
+    images is a sequence of (name, GIF data).  Returns the PNG data
+    and a mapping from name to (x, y, width, height).
+    """
+    decoded = []
+    width = 0
+    for name, data in images:
+        w, h, rows = decodeGIF(data)
+        decoded.append((name, w, h, rows))
+        width = max(width, w)
+    layout = {}
+    sheet = []
+    for name, w, h, rows in decoded:
+        layout[name] = (0, len(sheet), w, h)
+        padding = '\0\0\0\0' * (width - w)
+        sheet.extend([row + padding for row in rows])
+    return encodePNG(width, len(sheet), sheet), layout
+
+
+def makeRules(layout):
+    """Returns the CSS rules that show each image of the sprite.
+    """
+    rules = []
+    for name, selector in IMAGES:
+        x, y, width, height = layout[name]
+        rules.append('%s { background-position: %dpx %dpx; '
+                     'width: %dpx; height: %dpx; }\n'
+                     % (selector, -x, -y, width, height))
+    return ''.join(rules)
+
+
+def _read(path):
+    f = open(path, 'rb')
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+
+def _write(path, data):
+    f = open(path, 'wb')
+    try:
+        f.write(data)
+    finally:
+        f.close()
+
+
+def main(dir=_here):
+    images = [(name, _read(os.path.join(dir, name)))
+              for name, selector in IMAGES]
+    data, layout = buildSprite(images)
+    _write(os.path.join(dir, 'icons.png'), data)
+    css_path = os.path.join(dir, 'manual_styles.css')
+    css = _read(css_path)
+    start = css.index(BEGIN) + len(BEGIN)
+    end = css.index(END)
+    _write(css_path, css[:start] + makeRules(layout) + css[end:])
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -121,15 +121,3 @@ function manual_changeTemplate(node) {
   f.elements.template.value = node.options[node.selectedIndex].value;
   f.submit();
 }
-
-function rollover(node) {
-  var src = node.src;
-  if (src && src.substr(src.length - 5) == "_icon")
-    node.src = src.substr(0, src.length - 5) + "_rollover";
-}
-
-function rollout(node) {
-  var src = node.src;
-  if (src && src.substr(src.length - 9) == "_rollover")
-    node.src = src.substr(0, src.length - 9) + "_icon";
-}
@@ -0,0 +1,375 @@
+##############################################################################
+#
+# Copyright (c) 2011 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.0 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Order of the objects in a slot.
+
+$Id$
+"""
+
+from bisect import bisect_left
+from random import randint
+
+from BTrees.Length import Length
+from BTrees.OOBTree import OOBTree
+from BTrees.OOBTree import OOTreeSet
+from Persistence import Persistent
+
+# Distance between the positions of neighbouring objects.
+GAP = 1 << 20
+
+
+def _between(low, high):
+    """Returns a random position in the middle half of a gap.
+    """
+    span = high - low
+    return low + span // 4 + randint(1, max(span // 2, 1))
+
+
+def _keptIndexes(indexes):
+    """Returns the set of positions in a longest increasing run.
+
+    indexes holds the old index of each object in its new order, or
+    None for new objects.  The objects at the returned positions of
+    the new order keep their relative order, so only the others need
+    to move.  Takes O(n log n) time.
+    """
+    tails = []    # tails[k]: position ending the best run of length k+1
+    previous = {}  # position -> previous position in its run
+    values = []   # indexes[tails[k]] for bisecting
+    for i, index in enumerate(indexes):
+        if index is None:
+            continue
+        k = bisect_left(values, index)
+        if k > 0:
+            previous[i] = tails[k - 1]
+        if k == len(tails):
+            tails.append(i)
+            values.append(index)
+        else:
+            tails[k] = i
+            values[k] = index
+    kept = {}
+    i = None
+    if tails:
+        i = tails[-1]
+    while i is not None:
+        kept[i] = 1
+        i = previous.get(i)
+    return kept
+
+
+class Ordering(Persistent):
+    """The order of the objects in a slot.
+
+    Each object has an integer position.  Positions are spread out,
+    so an object can move between two others without renumbering the
+    rest, and moving, adding or removing one object changes only a
+    few BTree buckets instead of the whole list.  Neighbours are
+    found with range lookups on the BTree.
+
+    New positions are picked at random within their gap, so that two
+    transactions inserting at the same place pick different positions
+    and their changes merge.  Each new object then lands between the
+    same neighbours, but which of the two comes first is left to
+    chance.  Inserts at different places merge in a predictable order.
+
+    Null placeholders (see Slot.nullify) may appear more than once, so
+    they are not indexed by id.
+
+    The list of objects is cached in a volatile attribute for
+    reading.  Every change counts in _changes, a Length that merges
+    concurrent changes, so a connection notices changes committed
+    elsewhere.
+    """
+
+    null_id = "null_element"
+    _v_cache = None
+
+    def __init__(self, infos=()):
+        self._items = OOBTree()    # position -> (id, meta_type)
+        self._index = OOBTree()    # id -> position
+        self._nulls = OOTreeSet()  # positions of null placeholders
+        self._length = Length()
+        self._changes = Length()
+        self._fill(infos)
+
+    def _fill(self, infos):
+        pos = 0
+        for info in infos:
+            pos += GAP
+            self._add(pos, info['id'], info['meta_type'])
+
+    def _changed(self):
+        self._changes.change(1)
+        self._v_cache = None
+
+    def _getCacheKey(self):
+        changes = self._changes
+        return (changes(), changes._p_serial)
+
+    def _getCache(self):
+        """Returns (infos, ids) in order.
+        """
+        key = self._getCacheKey()
+        cache = self._v_cache
+        if cache is None or cache[0] != key:
+            items = self._items.values()
+            infos = tuple([{'id': id, 'meta_type': meta_type}
+                           for id, meta_type in items])
+            ids = tuple([id for id, meta_type in items])
+            cache = self._v_cache = (key, infos, ids)
+        return cache[1:]
+
+    def _add(self, pos, id, meta_type):
+        if id == self.null_id:
+            self._nulls.insert(pos)
+        elif self._index.has_key(id):
+            raise KeyError("Duplicate id: %s" % id)
+        else:
+            self._index[id] = pos
+        self._items[pos] = (id, meta_type)
+        self._length.change(1)
+        self._changed()
+
+    def _remove(self, pos):
+        id, meta_type = self._items[pos]
+        del self._items[pos]
+        if self._nulls.has_key(pos):
+            self._nulls.remove(pos)
+        else:
+            del self._index[id]
+        self._length.change(-1)
+        self._changed()
+        return meta_type
+
+    def __len__(self):
+        return self._length()
+
+    def has_key(self, id):
+        return self._index.has_key(id)
+
+    def ids(self):
+        return list(self._getCache()[1])
+
+    def infos(self):
+        """Returns the order as ObjectManager's _objects tuple.
+        """
+        return self._getCache()[0]
+
+    def _positionAt(self, index, skip=None):
+        """Returns a free position in front of the object at index.
+
+        skip is the position of an object to leave out of the list.
+        The neighbours are found by seeking in the BTree's keys, which
+        skips whole buckets, rather than by listing every object.  The
+        position is chosen at random within the gap, so that
+        concurrent inserts at the same place rarely pick the same
+        position and the BTrees can merge them.  Returns None if the
+        gap is full.
+        """
+        count = len(self)
+        if skip is not None:
+            count -= 1
+        if index < 0:
+            index = max(index + count, 0)
+        index = min(index, count)
+        keys = self._items.keys()
+
+        def at(i):
+            # Objects at or after skip shift down by one.
+            key = keys[i]
+            if skip is not None and key >= skip:
+                key = keys[i + 1]
+            return key
+
+        low = high = None
+        if index > 0:
+            low = at(index - 1)
+        if index < count:
+            high = at(index)
+        return self._positionBetween(low, high)
+
+    def _positionBetween(self, low, high):
+        if low is None and high is None:
+            return _between(0, 2 * GAP)
+        if high is None:
+            return _between(low, low + 2 * GAP)
+        if low is None:
+            return _between(high - 2 * GAP, high)
+        if high - low < 2:
+            return None
+        return _between(low, high)
+
+    def _positionAfter(self, previous, skip=None):
+        """Returns a free position right after the object called previous.
+
+        If previous is None, returns a position in front of all
+        objects.  skip is the position of an object to leave out.
+        """
+        low = high = None
+        if previous is not None:
+            low = self._index[previous]
+        try:
+            if low is None:
+                high = self._items.minKey()
+            else:
+                high = self._items.minKey(low + 1)
+            if high == skip:
+                high = self._items.minKey(high + 1)
+        except ValueError:
+            pass
+        if high == skip:
+            high = None
+        return self._positionBetween(low, high)
+
+    def reset(self, infos):
+        """Replaces the order with a sequence of {'id', 'meta_type'}.
+
+        Renumbers every object, so it is meant for rare cases, such as
+        a full gap.
+        """
+        infos = tuple(infos)
+        self._items.clear()
+        self._index.clear()
+        self._nulls.clear()
+        self._length.set(0)
+        self._fill(infos)
+        self._changed()
+
+    def update(self, infos):
+        """Makes the order match a sequence of {'id', 'meta_type'}.
+
+        Removes the objects that are gone, then adds or moves only the
+        objects that are out of place; the longest run of objects
+        still in order stays put.  Adding or removing one object, or
+        moving a few, therefore writes only a few BTree buckets.
+        Orders with null placeholders, or where most objects move, are
+        rebuilt instead.
+        """
+        infos = tuple(infos)
+        old = self.infos()
+        if infos == old:
+            return
+        if len(infos) == len(old) + 1 and infos[:-1] == old:
+            # ObjectManager._setObject() appended an object.
+            self.append(infos[-1]['id'], infos[-1]['meta_type'])
+        elif self._nulls or [info for info in infos
+                             if info['id'] == self.null_id]:
+            self.reset(infos)
+            return
+        else:
+            positions = {}
+            for i in range(len(old)):
+                positions[old[i]['id']] = i
+            indexes = []
+            for info in infos:
+                i = positions.pop(info['id'], None)
+                if i is not None and old[i]['meta_type'] != info['meta_type']:
+                    # Same id, another kind of object: add it anew.
+                    positions[info['id']] = i
+                    i = None
+                indexes.append(i)
+            kept = _keptIndexes(indexes)
+            if len(infos) - len(kept) > len(infos) // 2:
+                # Most objects move, so renumbering is cheaper.
+                self.reset(infos)
+                return
+            for id in positions.keys():
+                self.remove(id)
+            previous = None
+            for i in range(len(infos)):
+                id = infos[i]['id']
+                if not kept.has_key(i):
+                    if indexes[i] is None:
+                        self.insertAfter(previous, id, infos[i]['meta_type'])
+                    else:
+                        self.moveAfter(id, previous)
+                previous = id
+        # The order now matches infos, so there is no need to list
+        # the BTree again.
+        self._v_cache = (self._getCacheKey(), infos,
+                         tuple([info['id'] for info in infos]))
+
+    def insert(self, index, id, meta_type):
+        """Inserts an object like list.insert().
+        """
+        pos = self._positionAt(index)
+        if pos is None:
+            self.reset(self.infos())
+            pos = self._positionAt(index)
+        self._add(pos, id, meta_type)
+
+    def insertAfter(self, previous, id, meta_type):
+        """Inserts an object after another, or first if previous is None.
+        """
+        pos = self._positionAfter(previous)
+        if pos is None:
+            self.reset(self.infos())
+            pos = self._positionAfter(previous)
+        self._add(pos, id, meta_type)
+
+    def append(self, id, meta_type):
+        try:
+            last = self._items.maxKey()
+        except ValueError:
+            pos = self._positionBetween(None, None)
+        else:
+            pos = self._positionBetween(last, None)
+        self._add(pos, id, meta_type)
+
+    def remove(self, id):
+        """Removes an object.  Returns its meta_type.
+        """
+        return self._remove(self._index[id])
+
+    def move(self, id, index):
+        """Moves an object to an index of the list without it.
+        """
+        old = self._index[id]
+        pos = self._positionAt(index, old)
+        if pos is None:
+            self.reset(self.infos())
+            self.move(id, index)
+            return
+        if pos != old:
+            meta_type = self._remove(old)
+            self._add(pos, id, meta_type)
+
+    def moveAfter(self, id, previous):
+        """Moves an object after another, or first if previous is None.
+        """
+        if id == previous:
+            return
+        old = self._index[id]
+        pos = self._positionAfter(previous, old)
+        if pos is None:
+            self.reset(self.infos())
+            self.moveAfter(id, previous)
+            return
+        meta_type = self._remove(old)
+        self._add(pos, id, meta_type)
+
+    def nullify(self, id):
+        """Replaces an object with a null placeholder.
+        """
+        pos = self._index[id]
+        meta_type = self._items[pos][1]
+        del self._index[id]
+        self._items[pos] = (self.null_id, meta_type)
+        self._nulls.insert(pos)
+        self._changed()
+
+    def pack(self):
+        """Removes the null placeholders.
+        """
+        for pos in list(self._nulls):
+            self._remove(pos)
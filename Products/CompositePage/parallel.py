@@ -0,0 +1,257 @@
+##############################################################################
+#
+# Copyright (c) 2011 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.0 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Concurrent rendering of slot elements.
+
+Elements rendered this way run in a pool of worker threads.  Each
+worker opens its own ZODB connection and finds the element again, so
+no persistent object is shared between threads.
+
+$Id$
+"""
+
+import threading
+from Queue import Full
+from Queue import Queue
+from time import time
+
+import transaction
+from AccessControl.SecurityManagement import newSecurityManager
+from AccessControl.SecurityManagement import noSecurityManager
+from AccessControl.SpecialUsers import nobody
+from Acquisition import aq_base
+from Acquisition import aq_inner
+from Acquisition import aq_parent
+from ZODB.POSException import ConflictError
+from ZPublisher.BaseRequest import RequestContainer
+from zLOG import LOG, ERROR
+
+
+class Task:
+    """The eventual result of a function run by a ThreadPool.
+    """
+
+    def __init__(self, deadline=None):
+        self.deadline = deadline
+        self._event = threading.Event()
+        self._value = None
+        self._error = None
+
+    def set(self, value, error=None):
+        self._value = value
+        self._error = error
+        self._event.set()
+
+    def expired(self):
+        return self.deadline is not None and time() >= self.deadline
+
+    def wait(self, deadline):
+        """Waits until the given time.
+
+        Returns (done, value).  Raises the ConflictError that the
+        function ran into, so that the request can be retried.
+        """
+        timeout = deadline - time()
+        if timeout > 0:
+            self._event.wait(timeout)
+        if self._event.isSet():
+            if self._error is not None:
+                raise self._error
+            return 1, self._value
+        return 0, None
+
+
+class ThreadPool:
+    """A fixed number of daemon threads that run submitted functions.
+
+    Functions must catch their own exceptions; an exception that
+    escapes is logged and the result is None.  ConflictErrors are
+    passed on to the thread that waits for the result.  At most
+    max_queued calls wait for a thread; calls still waiting at their
+    deadline are skipped.
+    """
+
+    def __init__(self, size, max_queued=None):
+        self.size = size
+        if max_queued is None:
+            max_queued = size * 10
+        self._queue = Queue(max_queued)
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, deadline, func, *args):
+        """Queues a call that must start before the deadline.
+
+        Returns a Task, or None if the queue is full.
+        """
+        if len(self._threads) < self.size:
+            self._start()
+        task = Task(deadline)
+        try:
+            self._queue.put_nowait((task, func, args))
+        except Full:
+            return None
+        return task
+
+    def join(self):
+        """Waits until every queued call is done.
+        """
+        self._queue.join()
+
+    def _start(self):
+        self._lock.acquire()
+        try:
+            while len(self._threads) < self.size:
+                t = threading.Thread(target=self._work,
+                                     name="CompositeRenderer")
+                t.setDaemon(1)
+                t.start()
+                self._threads.append(t)
+        finally:
+            self._lock.release()
+
+    def _work(self):
+        while 1:
+            task, func, args = self._queue.get()
+            try:
+                if task.expired():
+                    # Nobody waits for the result any more.
+                    task.set(None)
+                else:
+                    self._run(task, func, args)
+            finally:
+                self._queue.task_done()
+
+    def _run(self, task, func, args):
+        try:
+            value = func(*args)
+        except ConflictError, e:
+            task.set(None, e)
+        except:
+            LOG("Composite", ERROR, "Error in a render thread",
+                error=1)
+            task.set(None)
+        else:
+            task.set(value)
+
+
+_pools = {}  # size -> ThreadPool
+_pools_lock = threading.Lock()
+
+
+def getPool(size):
+    """Returns the shared pool with the given number of threads.
+    """
+    _pools_lock.acquire()
+    try:
+        pool = _pools.get(size)
+        if pool is None:
+            pool = _pools[size] = ThreadPool(size)
+        return pool
+    finally:
+        _pools_lock.release()
+
+
+def getUserInfo(user):
+    """Returns what another thread needs to find the user again.
+    """
+    uf = aq_parent(aq_inner(user))
+    if uf is None or not hasattr(aq_base(uf), 'getPhysicalPath'):
+        # A special user such as nobody, which is not stored.
+        return None, user
+    return uf.getPhysicalPath(), user.getId()
+
+
+def _findUser(app, user_info):
+    uf_path, user = user_info
+    if uf_path is None:
+        return user
+    uf = app.unrestrictedTraverse(uf_path)
+    found = uf.getUserById(user)
+    if found is None:
+        return nobody
+    if not hasattr(found, 'aq_base'):
+        found = found.__of__(uf)
+    return found
+
+
+# Request variables that belong to the request's own thread.
+_local_request_keys = (
+    'RESPONSE', 'PARENTS', 'PUBLISHED', 'AUTHENTICATED_USER')
+
+
+def _isLocal(value):
+    """Returns true if value is tied to the connection of the request.
+    """
+    # Look at the object of bound methods.
+    value = getattr(value, 'im_self', value)
+    return hasattr(value, 'aq_base') or hasattr(value, '_p_jar')
+
+
+def cloneRequest(request):
+    """Copies what rendering needs from a request.
+
+    The copy has the same environment, form data, cookies and request
+    variables, so it generates the same URLs.  Variables that hold
+    objects of the request's own thread are left out: the response,
+    the traversal parents, the published object, the user, anything
+    persistent or wrapped in acquisition, and entries with other than
+    string keys, which are caches such as the dereference cache.
+    Call this in the thread that owns the request.
+    """
+    response = getattr(request, 'response', None)
+    if response is not None:
+        response = response.__class__()
+    clone = request.__class__(None, request.environ.copy(), response)
+    clone._script = list(request._script)
+    clone.form.update(request.form)
+    clone.cookies = request.cookies.copy()
+    taintedform = getattr(request, 'taintedform', None)
+    if taintedform is not None:
+        clone.taintedform = taintedform.copy()
+    for key, value in request.other.items():
+        if (isinstance(key, str) and key not in _local_request_keys
+            and not _isLocal(value)):
+            clone.other[key] = value
+    return clone
+
+
+def renderElement(db, root_oid, path, user_info, request, class_name,
+                  editing):
+    """Renders an element in a new connection.
+
+    Runs in a worker thread.  Returns (1, text), or (0, an error
+    message made by formatException).  ConflictErrors propagate.
+    """
+    from Products.CompositePage.slot import formatException
+    conn = db.open()
+    try:
+        app = conn.get(root_oid)
+        if request is not None:
+            request['PARENTS'] = [app]
+            app = app.__of__(RequestContainer(REQUEST=request))
+        newSecurityManager(request, _findUser(app, user_info))
+        try:
+            element = app.unrestrictedTraverse(path)
+            # Tell the element which slot class it is rendered in.
+            aq_parent(aq_inner(element))._v_class_name = class_name
+            try:
+                return 1, element.renderInline()
+            except ConflictError:
+                raise
+            except:
+                return 0, formatException(element, editing)
+        finally:
+            noSecurityManager()
+    finally:
+        transaction.abort()
+        conn.close()
@@ -17,20 +17,117 @@ $Id: rawfile.py,v 1.3 2004/04/03 16:35:32 shane Exp $
 """
 
 import os
+import re
 from os import stat
 from time import time
+from cStringIO import StringIO
+from gzip import GzipFile
+from hashlib import md5
 
 import Acquisition
-from Acquisition import aq_inner, aq_parent
+from Acquisition import aq_base, aq_inner, aq_parent
 import Globals
 from Globals import package_home
 from App.Common import rfc1123_date
 from DateTime import DateTime
 
+from Products.CompositePage.cache import LRUCache
+
+
+def makeETag(data):
+    """Returns a strong entity tag for some data.
+    """
+    return '"%s"' % md5(data).hexdigest()
+
+
+def gzipData(data):
+    """Returns data compressed with gzip.
+    """
+    out = StringIO()
+    f = GzipFile(fileobj=out, mode='wb', compresslevel=9)
+    f.write(data)
+    f.close()
+    return out.getvalue()
+
+
+css_comment_sub = re.compile(r"/\*.*?\*/", re.DOTALL).sub
+
+
+def minifyJS(data):
+    """Removes indentation, blank lines and whole-line comments.
+
+    Line breaks are kept so that automatic semicolon insertion still
+    works.
+    """
+    res = []
+    for line in data.splitlines():
+        line = line.strip()
+        if line and not line.startswith('//'):
+            res.append(line)
+    return '\n'.join(res)
+
+
+def minifyCSS(data):
+    """Removes comments, indentation and blank lines.
+    """
+    res = []
+    for line in css_comment_sub('', data).splitlines():
+        line = line.strip()
+        if line:
+            res.append(line)
+    return '\n'.join(res)
+
+
+def acceptsGzip(REQUEST):
+    """Returns true if the client accepts gzip content coding.
+    """
+    header = REQUEST.get_header('Accept-Encoding', None) or ''
+    for item in header.split(','):
+        parts = item.split(';')
+        if parts[0].strip().lower() not in ('gzip', 'x-gzip'):
+            continue
+        for param in parts[1:]:
+            param = param.strip().replace(' ', '')
+            if param in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+                return 0
+        return 1
+    return 0
+
+
+def publisherCompresses(RESPONSE):
+    """Returns true if ZPublisher will gzip the response body itself.
+
+    That is the case once something called
+    RESPONSE.enableHTTPCompression() for this request.
+    """
+    enable = getattr(RESPONSE, 'enableHTTPCompression', None)
+    if enable is None:
+        return 0
+    return enable(query=1)
+
+
+def matchesETag(REQUEST, etags):
+    """Returns true if an If-None-Match header matches one of the etags.
+
+    Returns None if there is no If-None-Match header.
+    """
+    header = REQUEST.get_header('If-None-Match', None)
+    if header is None:
+        return None
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag == '*' or tag in etags:
+            return 1
+    return 0
+
 
 class RawFile(Acquisition.Explicit):
     """Binary data stored in external files."""
 
+    # Content types worth compressing.  Images are already compressed.
+    compressible_types = ('text/', 'application/javascript',
+                          'application/x-javascript')
+
     def __init__(self, path, content_type, _prefix=None):
         if _prefix is None:
             _prefix = SOFTWARE_HOME
@@ -39,52 +136,155 @@ class RawFile(Acquisition.Explicit):
         path = os.path.join(_prefix, path)
         self.path = path
         self.cch = 'public, max-age=3600'  # One hour
+        self.immutable_cch = 'public, max-age=31536000, immutable'  # One year
 
-        file = open(path, 'rb')
-        data = file.read()
-        file.close()
         self.content_type = content_type
         self.__name__ = path.split('/')[-1]
-        self.lmt = float(stat(path)[8]) or time()
+        self._load()
+
+    def _load(self):
+        """Reads the file into memory.
+        """
+        file = open(self.path, 'rb')
+        try:
+            data = file.read()
+        finally:
+            file.close()
+        mtime = stat(self.path)[8]
+        etag = makeETag(data)
+        gzipped = self._compress(data)
+        # Replace the state in one assignment, since instances of
+        # this class are shared across threads.
+        self._state = (mtime, data, etag, gzipped)
+        self.lmt = float(mtime) or time()
         self.lmh = rfc1123_date(self.lmt)
 
+    def _compress(self, data):
+        """Returns the gzipped data, or None if not worth compressing.
+        """
+        for t in self.compressible_types:
+            if self.content_type.startswith(t):
+                return gzipData(data)
+        return None
+
+    def _getState(self):
+        """Returns (mtime, data, etag, gzipped data or None).
+
+        In debug mode, reloads the file when it changes, like other
+        filesystem-based objects in Zope.
+        """
+        state = self._state
+        if Globals.DevelopmentMode:
+            try:
+                mtime = stat(self.path)[8]
+            except OSError:
+                mtime = state[0]
+            if mtime != state[0]:
+                self._load()
+                state = self._state
+        return state
+
+    def _getContent(self):
+        """Returns (data, etag, gzipped data or None).
+        """
+        mtime, raw, etag, gzipped = self._getState()
+        data = self.interp(raw)
+        if data is not raw:
+            # The content was modified, so the precomputed validator
+            # and compressed copy don't apply.
+            return data, makeETag(data), None
+        return data, etag, gzipped
 
     def __call__(self, REQUEST=None, RESPONSE=None):
         """Default rendering"""
-        # HTTP If-Modified-Since header handling. This is duplicated
-        # from OFS.Image.Image - it really should be consolidated
-        # somewhere...
-        if RESPONSE is not None:
-            RESPONSE.setHeader('Content-Type', self.content_type)
-            RESPONSE.setHeader('Last-Modified', self.lmh)
-            RESPONSE.setHeader('Cache-Control', self.cch)
-            if REQUEST is not None:
-                header = REQUEST.get_header('If-Modified-Since', None)
-                if header is not None:
-                    header = header.split(';')[0]
-                    # Some proxies seem to send invalid date strings for this
-                    # header. If the date string is not valid, we ignore it
-                    # rather than raise an error to be generally consistent
-                    # with common servers such as Apache (which can usually
-                    # understand the screwy date string as a lucky side effect
-                    # of the way they parse it).
-                    try:
-                        mod_since = long(DateTime(header).timeTime())
-                    except:
-                        mod_since = None
-                    if mod_since is not None:
-                        if getattr(self, 'lmt', None):
-                            last_mod = long(self.lmt)
-                        else:
-                            last_mod = long(0)
-                        if last_mod > 0 and last_mod <= mod_since:
-                            RESPONSE.setStatus(304)
-                            return ''
-
-        f = open(self.path, 'rb')
-        data = f.read()
-        f.close()
-        data = self.interp(data)
+        data, etag, gzipped = self._getContent()
+        if RESPONSE is None:
+            return data
+        return self._serve(data, etag, gzipped, REQUEST, RESPONSE, self.cch)
+
+    def _getLastModified(self):
+        """Returns (time, HTTP date) of the last modification.
+        """
+        return self.lmt, self.lmh
+
+    def fingerprint(self):
+        """Returns a short hash of the content.
+
+        Publishing the file at <name>/<fingerprint> gives it a URL
+        that changes whenever the content changes.
+        """
+        return self._getContent()[1][1:13]
+
+    def __bobo_traverse__(self, REQUEST, name):
+        if hasattr(aq_base(self), name):
+            return getattr(self, name)
+        return FingerprintedFile(name).__of__(self)
+
+    def _serveFingerprinted(self, fingerprint, REQUEST, RESPONSE):
+        data, etag, gzipped = self._getContent()
+        if RESPONSE is None:
+            return data
+        if fingerprint == etag[1:13]:
+            cch = self.immutable_cch
+        else:
+            # The URL refers to an older version, so don't let anyone
+            # keep the current content under it for long.
+            cch = self.cch
+        return self._serve(data, etag, gzipped, REQUEST, RESPONSE, cch)
+
+    def _serve(self, data, etag, gzipped, REQUEST, RESPONSE, cch):
+        """Sets the response headers and returns the body.
+        """
+        lmt, lmh = self._getLastModified()
+        RESPONSE.setHeader('Content-Type', self.content_type)
+        RESPONSE.setHeader('Last-Modified', lmh)
+        RESPONSE.setHeader('Cache-Control', cch)
+        if gzipped is not None:
+            gzip_etag = etag[:-1] + '-gzip"'
+            RESPONSE.setHeader('Vary', 'Accept-Encoding')
+            if publisherCompresses(RESPONSE):
+                # Sending the gzipped copy would compress it twice.
+                etag = gzip_etag
+            elif REQUEST is not None and acceptsGzip(REQUEST):
+                etag = gzip_etag
+                data = gzipped
+                RESPONSE.setHeader('Content-Encoding', 'gzip')
+            etags = (etag, gzip_etag)
+        else:
+            etags = (etag,)
+        RESPONSE.setHeader('ETag', etag)
+        if REQUEST is not None:
+            match = matchesETag(REQUEST, etags)
+            if match is not None:
+                # If-None-Match takes precedence over If-Modified-Since.
+                if match:
+                    RESPONSE.setStatus(304)
+                    return ''
+                return data
+            # HTTP If-Modified-Since header handling. This is duplicated
+            # from OFS.Image.Image - it really should be consolidated
+            # somewhere...
+            header = REQUEST.get_header('If-Modified-Since', None)
+            if header is not None:
+                header = header.split(';')[0]
+                # Some proxies seem to send invalid date strings for this
+                # header. If the date string is not valid, we ignore it
+                # rather than raise an error to be generally consistent
+                # with common servers such as Apache (which can usually
+                # understand the screwy date string as a lucky side effect
+                # of the way they parse it).
+                try:
+                    mod_since = long(DateTime(header).timeTime())
+                except:
+                    mod_since = None
+                if mod_since is not None:
+                    if lmt:
+                        last_mod = long(lmt)
+                    else:
+                        last_mod = long(0)
+                    if last_mod > 0 and last_mod <= mod_since:
+                        RESPONSE.setStatus(304)
+                        return ''
         return data
 
     def interp(self, data):
@@ -97,19 +297,129 @@ class RawFile(Acquisition.Explicit):
     HEAD__roles__ = None
     def HEAD(self, REQUEST, RESPONSE):
         """ """
+        # Get the content first, which reloads changed files.
+        etag = self._getContent()[1]
         RESPONSE.setHeader('Content-Type', self.content_type)
-        RESPONSE.setHeader('Last-Modified', self.lmh)
+        RESPONSE.setHeader('Last-Modified', self._getLastModified()[1])
+        RESPONSE.setHeader('ETag', etag)
         return ''
 
 
+class FingerprintedFile(Acquisition.Explicit):
+    """A RawFile published under a URL that includes its fingerprint.
+    """
+    __roles__ = None
+    index_html = None  # Tells ZPublisher to use __call__
+
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+
+    def __call__(self, REQUEST=None, RESPONSE=None):
+        """Serves the file, cacheable for a long time."""
+        f = aq_parent(aq_inner(self))
+        return f._serveFingerprinted(self.fingerprint, REQUEST, RESPONSE)
+
+    HEAD__roles__ = None
+    def HEAD(self, REQUEST, RESPONSE):
+        """ """
+        return aq_parent(aq_inner(self)).HEAD(REQUEST, RESPONSE)
+
+
+class BundleFile(RawFile):
+    """Several files held by the same object, served as one.
+
+    The files are concatenated in order, after interpolation, and
+    minified.  The bundle is built on the first request and rebuilt
+    when one of the files changes.  It is cached per parent URL.  It
+    was last modified when the newest of the files was.
+    """
+
+    def __init__(self, names, content_type):
+        self.names = tuple(names)
+        self.content_type = content_type
+        self.cch = 'public, max-age=3600'  # One hour
+        self.immutable_cch = 'public, max-age=31536000, immutable'  # One year
+        self.__name__ = '+'.join(self.names)
+        self._cache = LRUCache(50)
+
+    def _getFiles(self):
+        parent = aq_parent(aq_inner(self))
+        return [getattr(parent, name) for name in self.names]
+
+    def _getLastModified(self):
+        res = None
+        for f in self._getFiles():
+            modified = f._getLastModified()
+            if res is None or modified[0] > res[0]:
+                res = modified
+        return res
+
+    def _getContent(self):
+        contents = [f._getContent() for f in self._getFiles()]
+        etags = tuple([content[1] for content in contents])
+        parent_url = aq_parent(aq_inner(self)).absolute_url()
+        cached = self._cache.get(parent_url)
+        if cached is not None and cached[0] == etags:
+            return cached[1]
+        data = '\n'.join([self.minify(content[0]) for content in contents])
+        content = (data, makeETag(data), self._compress(data))
+        self._cache.set(parent_url, (etags, content))
+        return content
+
+    def minify(self, data):
+        if self.content_type == 'text/css':
+            return minifyCSS(data)
+        if self.content_type.endswith('javascript'):
+            return minifyJS(data)
+        return data
+
+
+class InterpolationMapping:
+    """Values available to %(xxx)s interpolation.
+
+    'parent_url' is the URL of the object that holds the file.
+    'asset:name' is the fingerprinted URL of another file held by
+    that object.
+    """
+
+    def __init__(self, parent, parent_url):
+        self.parent = parent
+        self.parent_url = parent_url
+
+    def __getitem__(self, key):
+        if key == 'parent_url':
+            return self.parent_url
+        if key.startswith('asset:'):
+            name = key[6:]
+            f = getattr(self.parent, name)
+            return '%s/%s/%s' % (self.parent_url, name, f.fingerprint())
+        raise KeyError(key)
+
+
 class InterpolatedFile(RawFile):
     """Text data, stored in a file, with %(xxx)s interpolation.
+
+    The interpolated text is cached per parent URL.  The parent URL
+    varies with virtual hosting, so the cache is bounded.
     """
 
-    def interp(self, data):
+    def __init__(self, path, content_type, _prefix=None):
+        RawFile.__init__(self, path, content_type, _prefix)
+        self._cache = LRUCache(50)
+
+    def _getContent(self):
+        state = self._getState()
         parent_url = aq_parent(aq_inner(self)).absolute_url()
-        d = {
-            "parent_url": parent_url,
-            }
-        return data % d
+        cached = self._cache.get(parent_url)
+        if cached is not None and cached[0] is state:
+            return cached[1]
+        data = self.interp(state[1], parent_url)
+        content = (data, makeETag(data), self._compress(data))
+        self._cache.set(parent_url, (state, content))
+        return content
 
+    def interp(self, data, parent_url=None):
+        parent = aq_parent(aq_inner(self))
+        if parent_url is None:
+            parent_url = parent.absolute_url()
+        return data % InterpolationMapping(parent, parent_url)
@@ -19,6 +19,9 @@ $Id: slot.py,v 1.21 2004/04/26 09:30:25 gotcha Exp $
 import os
 import sys
 from cgi import escape
+from time import time
+from urllib import quote
+from uuid import uuid4
 
 import Globals
 from Acquisition import aq_base
@@ -29,13 +32,22 @@ from ZODB.POSException import ConflictError
 from OFS.SimpleItem import SimpleItem
 from Products.PageTemplates.PageTemplateFile import PageTemplateFile
 from AccessControl import ClassSecurityInfo
+from AccessControl import getSecurityManager
 from zLOG import LOG, ERROR
 from zope.interface import implements
 
 from Products.CompositePage.interfaces import ICompositeElement
 from Products.CompositePage.interfaces import ISlot
+from Products.CompositePage.interfaces import RenderTimeoutError
 from Products.CompositePage.perm_names import view_perm
 from Products.CompositePage.perm_names import change_composites_perm
+from Products.CompositePage.parallel import cloneRequest
+from Products.CompositePage.parallel import getPool
+from Products.CompositePage.parallel import getUserInfo
+from Products.CompositePage.parallel import renderElement
+from Products.CompositePage.cache import LRUCache
+from Products.CompositePage.ordering import Ordering
+from Products.CompositePage.utils import getUserKey
 
 
 try:
@@ -65,6 +77,48 @@ view_tag = '''<div>
 error_tag = '''<span class="slot_error">%s
 (<a href="%s" onmousedown="document.location=this.href">log</a>)</span>'''
 
+# timeout_tag stands in for elements that ran out of time and have
+# no earlier rendering to show instead.
+timeout_tag = '''<span class="slot_timeout">This part of the page is
+not available right now.</span>'''
+
+# esi_tag asks an ESI proxy to insert an element rendered separately.
+esi_tag = '''<esi:include src="%s" />'''
+
+# deferred_tag marks an element that a streaming design view renders
+# when the response reaches it.
+deferred_tag = '''<!--deferred element %s-->'''
+
+# Last successful renderings of elements that may run out of time:
+# (element path, user id or None, roles) -> text
+_last_good = LRUCache(1000)
+
+try:
+    from zope.testing.cleanup import addCleanUp
+except ImportError:
+    pass
+else:
+    addCleanUp(_last_good.clear)
+
+
+_marker = []
+
+
+def _sameState(a, b):
+    """Compares attribute values of a conflicting state.
+    """
+    if a is b:
+        return 1
+    if a is _marker or b is _marker:
+        return 0
+    try:
+        return a == b
+    except ConflictError:
+        raise
+    except:
+        # Persistent references can't always be compared.
+        return 0
+
 
 class NullElement(SimpleItem):
     """Empty placeholder for slot content
@@ -84,7 +138,7 @@ class Slot(OrderedFolder):
     security = ClassSecurityInfo()
 
     null_element = NullElement("null_element")
-
+    _v_class_name = None  # Set by the slot generator while rendering
 
     def __init__(self, id):
         self.id = id
@@ -117,30 +171,105 @@ class Slot(OrderedFolder):
 
     __unicode__ = __str__
 
+    # The order of the contents, created on the first change.  Older
+    # slots keep their order in an _objects tuple until then.
+    _ordering = None
+
+    def _getOrdering(self):
+        ordering = self._ordering
+        if ordering is None:
+            ordering = Ordering(self.__dict__.get('_objects', ()))
+            if self.__dict__.has_key('_objects'):
+                del self.__dict__['_objects']
+            self._ordering = ordering
+        return ordering
+
+    def _get_objects(self):
+        if self._ordering is not None:
+            return self._ordering.infos()
+        return self.__dict__.get('_objects', ())
+
+    def _set_objects(self, objects):
+        # ObjectManager and OrderSupport assign a whole new tuple.
+        # The ordering writes only the objects that were added,
+        # removed or moved.
+        self._getOrdering().update(objects)
+
+    _objects = property(_get_objects, _set_objects)
+
+    def objectIds(self, spec=None):
+        if self._ordering is None:
+            return OrderedFolder.objectIds(self, spec)
+        if spec is None:
+            return self._ordering.ids()
+        if isinstance(spec, basestring):
+            spec = [spec]
+        return [info['id'] for info in self._ordering.infos()
+                if info['meta_type'] in spec]
+
+    def objectValues(self, spec=None):
+        return [self._getOb(id) for id in self.objectIds(spec)]
+
+    def objectItems(self, spec=None):
+        return [(id, self._getOb(id)) for id in self.objectIds(spec)]
+
+    def _p_resolveConflict(self, old_state, saved_state, new_state):
+        """Merges concurrent changes to different attributes.
+
+        Adding and removing elements changes the attributes that hold
+        them; the order is kept in BTrees, which merge on their own.
+        Changes to the same attribute still conflict.
+        """
+        for state in (old_state, saved_state, new_state):
+            if not isinstance(state, dict):
+                raise ConflictError
+        res = saved_state.copy()
+        keys = {}
+        keys.update(old_state)
+        keys.update(new_state)
+        for key in keys.keys():
+            old = old_state.get(key, _marker)
+            new = new_state.get(key, _marker)
+            if _sameState(old, new):
+                continue
+            saved = saved_state.get(key, _marker)
+            if not _sameState(saved, old) and not _sameState(saved, new):
+                raise ConflictError
+            if new is _marker:
+                if res.has_key(key):
+                    del res[key]
+            else:
+                res[key] = new
+        return res
+
     security.declareProtected(change_composites_perm, "reorder")
     def reorder(self, name, new_index):
-        if name not in self.objectIds():
+        ordering = self._getOrdering()
+        if not ordering.has_key(name):
             raise KeyError, name
-        objs = [info for info in self._objects if info['id'] != name]
-        objs.insert(new_index,
-                    {'id': name, 'meta_type': getattr(self, name).meta_type})
-        self._objects = tuple(objs)
+        ordering.move(name, new_index)
+
+    security.declareProtected(change_composites_perm, "reorderAfter")
+    def reorderAfter(self, name, previous):
+        """Moves an element after another, or first if previous is None.
+        """
+        ordering = self._getOrdering()
+        if not ordering.has_key(name):
+            raise KeyError, name
+        ordering.moveAfter(name, previous)
 
     security.declareProtected(change_composites_perm, "nullify")
     def nullify(self, name):
         res = self[name]
-        objs = list(self._objects)
         # Replace the item with a pointer to the null element.
-        for info in objs:
-            if info["id"] == name:
-                info["id"] = "null_element"
+        self._getOrdering().nullify(name)
         delattr(self, name)
         return res
 
     security.declareProtected(change_composites_perm, "nullify")
     def pack(self):
-        objs = [info for info in self._objects if info["id"] != "null_element"]
-        self._objects = tuple(objs)
+        if self._ordering is not None:
+            self._ordering.pack()
 
     security.declareProtected(view_perm, "renderToList")
     def renderToList(self, allow_add):
@@ -165,29 +294,192 @@ class Slot(OrderedFolder):
         if editing and allow_add:
             res.append(self._render_add_target(myid, 0, mypath))
 
+        deferred = getattr(composite, '_v_deferred', None)
+        if getattr(composite, '_v_esi', 0):
+            texts = self._renderIncludes(items)
+        elif deferred is not None:
+            texts = self._deferElements(items, deferred)
+        else:
+            texts = self._renderElements(items, editing, composite)
         for index in range(len(items)):
             name, obj = items[index]
+            text = texts[index]
 
+            if editing:
+                res.append(self._render_editing(obj, text, icon_base_url))
+            else:
+                res.append(view_tag % text)
+            
+            if editing and allow_add:
+                res.append(self._render_add_target(myid, index+1, mypath, obj.getId()))
+
+        return res
+
+    def _renderElements(self, items, editing, composite):
+        """Renders the elements of the slot.
+
+        Returns {index: text}.  Elements that run out of time are
+        replaced by their last good rendering, or by a placeholder.
+        """
+        # A deadline for the whole composite, if it has a budget.
+        budget_deadline = getattr(composite, '_v_render_deadline', None)
+        # Start the concurrent renderings first so that they proceed
+        # while this thread renders the other elements.
+        tasks = self._startRenderTasks(items, editing, budget_deadline)
+        keep = budget_deadline is not None or tasks
+        texts = {}
+        timed_out = []
+        for index in range(len(items)):
+            if tasks.has_key(index):
+                continue
+            name, obj = items[index]
+            if budget_deadline is not None and time() > budget_deadline:
+                timed_out.append(index)
+                continue
             try:
                 assert ICompositeElement.providedBy(obj), (
                     "Not a composite element: %s" % repr(obj))
-                text = obj.renderInline()
+                texts[index] = text = obj.renderInline()
             except ConflictError:
                 # Ugly ZODB requirement: don't catch ConflictErrors
                 raise
             except:
-                text = formatException(self, editing)
+                texts[index] = formatException(self, editing)
+            else:
+                if keep:
+                    _last_good.set(self._getLastGoodKey(obj), text)
+        for index, (task, deadline) in tasks.items():
+            name, obj = items[index]
+            if budget_deadline is not None:
+                # Never wait past the page budget, whatever the
+                # element's own timeout.
+                deadline = min(deadline, budget_deadline)
+            done, res = task.wait(deadline)
+            if not done or res is None:
+                timed_out.append(index)
+                continue
+            ok, text = res
+            texts[index] = text
+            if ok:
+                _last_good.set(self._getLastGoodKey(obj), text)
+        if timed_out:
+            # Let the composite know that the page is incomplete.
+            composite._v_timed_out = 1
+            for index in timed_out:
+                name, obj = items[index]
+                texts[index] = self._renderTimedOut(obj, editing)
+        return texts
+
+    def _renderIncludes(self, items):
+        """Returns {index: text} with Edge Side Includes for elements.
+
+        A proxy that supports ESI fetches and caches each element
+        separately.
+        """
+        if self._v_class_name:
+            query = '?class_name=%s' % quote(self._v_class_name)
+        else:
+            query = ''
+        texts = {}
+        for index in range(len(items)):
+            name, obj = items[index]
+            if hasattr(aq_base(obj), 'renderFragment'):
+                url = '%s/renderFragment%s' % (obj.absolute_url(), query)
+                texts[index] = esi_tag % escape(url, 1)
+            else:
+                try:
+                    assert ICompositeElement.providedBy(obj), (
+                        "Not a composite element: %s" % repr(obj))
+                    texts[index] = obj.renderInline()
+                except ConflictError:
+                    raise
+                except:
+                    texts[index] = formatException(self, 0)
+        return texts
+
+    def _deferElements(self, items, deferred):
+        """Returns {index: marker} for elements to render later.
+
+        Stores (slot, item, class name) for each marker in deferred.
+        See Composite.design().
+        """
+        texts = {}
+        for index in range(len(items)):
+            marker = deferred_tag % uuid4().hex
+            deferred[marker] = (self, items[index], self._v_class_name)
+            texts[index] = marker
+        return texts
 
+    def _getLastGoodKey(self, obj):
+        # Renderings depend on the user, so one user's rendering must
+        # never stand in for another's.
+        return (obj.getPhysicalPath(),) + getUserKey(self)
 
+    def _renderTimedOut(self, obj, editing):
+        """Returns the text that replaces an element that ran out of time.
+
+        Logs the incident like other rendering errors.
+        """
+        try:
+            raise RenderTimeoutError(
+                "Ran out of time to render %s" % '/'.join(
+                obj.getPhysicalPath()))
+        except RenderTimeoutError:
             if editing:
-                res.append(self._render_editing(obj, text, icon_base_url))
+                # Show editors the error.
+                return formatException(self, editing)
+            logException(self, sys.exc_info())
+        text = _last_good.get(self._getLastGoodKey(obj))
+        if text is None:
+            text = timeout_tag
+        return text
+
+    def _startRenderTasks(self, items, editing, budget_deadline=None):
+        """Starts rendering the elements that run in other threads.
+
+        Returns {index: (task, deadline)}, where deadline ends the
+        element's own timeout.  Returns nothing when this slot is not
+        stored, since other threads could not load it.
+        """
+        jar = self._p_jar
+        tool = aq_get(self, "composite_tool", None, 1)
+        if jar is None or tool is None:
+            return {}
+        root_oid = getattr(aq_base(self.getPhysicalRoot()), '_p_oid', None)
+        if root_oid is None:
+            return {}
+        tasks = {}
+        pool = None
+        for index in range(len(items)):
+            name, obj = items[index]
+            base = aq_base(obj)
+            if (getattr(base, '_p_oid', None) is None or base._p_changed
+                or not hasattr(base, 'shouldRenderConcurrently')
+                or not obj.shouldRenderConcurrently()):
+                # Other threads can only see committed elements.
+                continue
+            if pool is None:
+                pool = getPool(tool.render_threads)
+                user_info = getUserInfo(getSecurityManager().getUser())
+                request = getattr(self, 'REQUEST', None)
+            timeout = getattr(base, 'render_timeout', 0) or tool.render_timeout
+            deadline = time() + timeout
+            start_by = deadline
+            if budget_deadline is not None:
+                start_by = min(deadline, budget_deadline)
+            if request is not None:
+                clone = cloneRequest(request)
             else:
-                res.append(view_tag % text)
-            
-            if editing and allow_add:
-                res.append(self._render_add_target(myid, index+1, mypath, obj.getId()))
-
-        return res
+                clone = None
+            task = pool.submit(
+                start_by, renderElement, jar.db(), root_oid,
+                obj.getPhysicalPath(), user_info, clone, self._v_class_name,
+                editing)
+            if task is None:
+                # The pool is busy; render in this thread.
+                continue
+            tasks[index] = (task, deadline)
+        return tasks
 
     def _render_editing(self, obj, text, icon_base_url):
         o2 = obj.dereference()
@@ -235,23 +527,35 @@ def formatException(context, editing):
             # Show viewers a simplified error.
             msg = ("An error occurred while generating "
                     "this part of the page.")
-        try:
-            log = aq_get(context, '__error_log__', None, 1)
-            raising = getattr(log, 'raising', None)
-        except AttributeError:
-            raising = None
-
-        if raising is not None:
-            error_log_url = raising(exc_info)
+        error_log_url = logException(context, exc_info)
+        if error_log_url is not None:
             return error_tag % (msg, error_log_url)
         else:
-            LOG("Composite", ERROR, "Error in a page element",
-                error=exc_info)
             return msg
     finally:
         del exc_info
 
 
+def logException(context, exc_info):
+    """Logs an error in a page element.
+
+    Uses the error log if there is one.  Returns the URL of the log
+    entry, or None.
+    """
+    try:
+        log = aq_get(context, '__error_log__', None, 1)
+        raising = getattr(log, 'raising', None)
+    except AttributeError:
+        raising = None
+
+    if raising is not None:
+        return raising(exc_info)
+    else:
+        LOG("Composite", ERROR, "Error in a page element",
+            error=exc_info)
+        return None
+
+
 addSlotForm = PageTemplateFile("addSlotForm.zpt", _www)
 
 def manage_addSlot(dispatcher, id, REQUEST=None):
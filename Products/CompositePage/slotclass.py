@@ -36,6 +36,8 @@ class SlotClass(SimpleItem, PropertyManager):
     implements(ISlotClass)
     meta_type = "Composite Slot Class"
     find_script = ""
+    cache_ttl = 0
+    render_concurrently = 0
 
     manage_options = (PropertyManager.manage_options
                       + SimpleItem.manage_options)
@@ -43,6 +45,10 @@ class SlotClass(SimpleItem, PropertyManager):
     _properties = (
         {'id': 'find_script', 'mode': 'w', 'type': 'string',
          'label': 'Script that finds available elements',},
+        {'id': 'cache_ttl', 'mode': 'w', 'type': 'int',
+         'label': 'Seconds to cache rendered elements (0 = no caching)',},
+        {'id': 'render_concurrently', 'mode': 'w', 'type': 'boolean',
+         'label': 'Render elements in separate threads',},
         )
 
     def findAvailableElements(self, slot):
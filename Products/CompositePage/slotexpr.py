@@ -20,16 +20,34 @@ $Id: slotexpr.py,v 1.5 2004/05/03 16:02:40 sidnei Exp $
 import logging
 import re
 
+from Acquisition import aq_base
 from zope.tales.tales import CompilerError
 
 from Products.CompositePage.interfaces import IComposite
+from Products.CompositePage.cache import LRUCache
 
 name_re = re.compile("\s*([a-zA-Z][a-zA-Z0-9_]*)")
 class_name_re = re.compile("\s*[(]([a-zA-Z][a-zA-Z0-9_]*)[)]")
 title_re = re.compile("\s*[']([^']+)[']")
 
+# Expressions that may look up slots without using the slot: type.
+dynamic_slots_search = re.compile(r"\bslots\b").search
+
+# Opcodes that include programs not known until rendering.
+dynamic_opcodes = ('useMacro', 'extendMacro')
+
 log = logging.getLogger(__name__)
 
+# Slot specs found in templates: id(template) -> (program, specs)
+_spec_cache = LRUCache(200)
+
+try:
+    from zope.testing.cleanup import addCleanUp
+except ImportError:
+    pass
+else:
+    addCleanUp(_spec_cache.clear)
+
 
 class SlotExpr(object):
     """Slot expression type.
@@ -81,6 +99,66 @@ class SlotExpr(object):
     def __repr__(self):
         return '<SlotExpr %s>' % repr(self._s)
 
+    def getSlotSpec(self):
+        return {
+            'name': self._name,
+            'class_name': self._class_name,
+            'title': self._title,
+            }
+
+
+def findSlotSpecs(template):
+    """Returns the slot specs of a template without rendering it.
+
+    Reads the slot expressions in the compiled program of a page
+    template.  Returns None if the template is not a page template or
+    if it might use slots some other way, such as through a path or
+    Python expression that mentions 'slots' or through a macro.  The
+    result is cached until the template is recompiled.
+    """
+    cook = getattr(template, '_cook_check', None)
+    if cook is None:
+        return None
+    cook()
+    if getattr(template, '_v_errors', None):
+        return None
+    program = getattr(template, '_v_program', None)
+    if program is None:
+        return None
+    key = id(aq_base(template))
+    cached = _spec_cache.get(key)
+    if cached is not None and cached[0] is program:
+        return cached[1]
+    specs = []
+    if not _findSlotExprs(program, specs):
+        specs = None
+    _spec_cache.set(key, (program, specs))
+    return specs
+
+
+def _findSlotExprs(program, specs):
+    """Appends the specs of slot expressions found in a TAL program.
+
+    Returns false if the program might use slots dynamically.
+    """
+    for item in program:
+        if isinstance(item, SlotExpr):
+            specs.append(item.getSlotSpec())
+        elif isinstance(item, (tuple, list)):
+            if item and item[0] in dynamic_opcodes:
+                return 0
+            if not _findSlotExprs(item, specs):
+                return 0
+        elif isinstance(item, dict):
+            if not _findSlotExprs(item.values(), specs):
+                return 0
+        elif not isinstance(item, basestring):
+            # Compiled expressions keep their source text.
+            text = getattr(item, '_s', None) or getattr(item, 'text', None)
+            if isinstance(text, basestring) and dynamic_slots_search(text):
+                return 0
+    return 1
+
 
 def registerSlotExprType():
     # Register the 'slot:' expression type.
@@ -0,0 +1,342 @@
+##############################################################################
+#
+# Copyright (c) 2011 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.0 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Composite page benchmarks.
+
+Builds a synthetic composite page and times the operations that
+matter for serving and editing it.  Nested composites are elements
+that refer to other composites, down to the given depth.  Run it with
+the Python of a Zope instance:
+
+  python benchmark.py --slots 5 --elements 10 --depth 2
+  python benchmark.py --save-baseline baseline.json
+  python benchmark.py --compare baseline.json
+
+Allocations are reported as the number of garbage collected objects
+that an operation leaves behind; Python 2 has no way to count the
+objects allocated and freed along the way.  The exit status is 1 if
+an operation fails or, when comparing, if an operation of the baseline
+got slower than the tolerance allows or has no result.
+
+This module is not a test module, so the test runner ignores it.
+
+$Id$
+"""
+
+import gc
+import sys
+import time
+from optparse import OptionParser
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import Products.CompositePage  # Registers the design UIs
+from AccessControl.SecurityManagement import noSecurityManager
+from AccessControl.SecurityManager import setSecurityPolicy
+from Acquisition import aq_base
+from OFS.Folder import Folder
+from Products.PageTemplates.ZopePageTemplate import ZopePageTemplate
+from ZPublisher.HTTPRequest import HTTPRequest
+from ZPublisher.HTTPResponse import HTTPResponse
+from zope.testing.cleanup import cleanUp
+
+from Products.CompositePage.composite import Composite
+from Products.CompositePage.element import CompositeElement
+from Products.CompositePage.slot import Slot
+from Products.CompositePage.tool import CompositeTool
+from Products.CompositePage.tool import _uis
+from Products.CompositePage.utils import copiesOf
+from Products.CompositePage.tests.test_tool import PermissiveSecurityPolicy
+from Products.CompositePage.tests.test_designuis import FakeUI
+from Products.CompositePage.tests.test_designuis import make_page
+from Products.CompositePage.tests.test_designuis import splice_fragments
+
+
+class Root(Folder):
+    """Root of the synthetic site"""
+
+    def getPhysicalPath(self):
+        return ('',)
+
+    def getPhysicalRoot(self):
+        return self
+
+
+def makeTemplate(slots):
+    lines = ['<html>', '<head><title>Page</title></head>', '<body>']
+    for i in range(slots):
+        lines.append('<div tal:replace="structure slot: slot_%d '
+                     '\'Slot %d\'">slot</div>' % (i, i))
+    lines.extend(['</body>', '</html>', ''])
+    return '\n'.join(lines)
+
+
+def buildComposite(root, name, slots, elements, depth):
+    """Adds a composite page to the root.
+
+    The first element of each slot refers to a nested composite as
+    long as depth allows; the others refer to page templates.
+    """
+    composite = Composite()
+    composite._setId(name)
+    root._setObject(name, composite)
+    composite = root._getOb(name)
+    composite.template = ZopePageTemplate(
+        id='template', text=makeTemplate(slots), content_type='text/html')
+    for i in range(slots):
+        slot_id = 'slot_%d' % i
+        composite.filled_slots._setObject(slot_id, Slot(slot_id))
+        slot = composite.filled_slots._getOb(slot_id)
+        for j in range(elements):
+            if j == 0 and depth > 1:
+                target = buildComposite(root, '%s_c%d' % (name, i), slots,
+                                        elements, depth - 1)
+                template_name = 'call'
+            else:
+                target_id = '%s_%d_%d' % (name, i, j)
+                root._setObject(target_id, ZopePageTemplate(
+                    id=target_id, text='<p>Element %d.%d</p>' % (i, j)))
+                target = root._getOb(target_id)
+                template_name = ''
+            e = CompositeElement('e%d' % j, target)
+            e.template_name = template_name
+            slot._setObject(e.id, e)
+    return composite
+
+
+def setUp():
+    cleanUp()
+    from zope.component import getGlobalSiteManager
+    from zope.interface import Interface
+    from zope.traversing.interfaces import ITraversable
+    from zope.traversing.adapters import DefaultTraversable
+    getGlobalSiteManager().registerAdapter(
+        DefaultTraversable, [Interface], ITraversable)
+    setSecurityPolicy(PermissiveSecurityPolicy())
+    noSecurityManager()
+
+
+def newRequest(root):
+    root.REQUEST = HTTPRequest(
+        '', dict(HTTP_HOST='localhost:8080'), HTTPResponse())
+
+
+def listBenchmarks(root, page):
+    """Returns [(name, operation)].
+
+    Every operation starts a new request, so that nothing cached per
+    request carries over from one operation to the next.
+    """
+    slot_path = '/'.join(page.filled_slots.slot_0.getPhysicalPath())
+
+    def render():
+        newRequest(root)
+        page()
+
+    def manifest():
+        newRequest(root)
+        page.getManifest()
+
+    def slot_specs():
+        newRequest(root)
+        page.getSlotSpecs()
+
+    def move():
+        # Moves the first element to the end of its slot.
+        newRequest(root)
+        first = page.filled_slots.slot_0.objectIds()[0]
+        root.composite_tool.moveElements(
+            ['%s/%s' % (slot_path, first)], slot_path,
+            len(page.filled_slots.slot_0.objectIds()))
+
+    # Pasting copies the elements of the first slot into an extra
+    # slot.  Each paste also deletes the copies again, so that the
+    # slot does not grow.
+    page.filled_slots._setObject('pasted', Slot('pasted'))
+    pasted = page.filled_slots.pasted
+    pasted_path = '/'.join(pasted.getPhysicalPath())
+    clipboard = ['%s/%s' % (slot_path, id)
+                 for id in page.filled_slots.slot_0.objectIds()]
+
+    def paste():
+        newRequest(root)
+        tool = root.composite_tool
+        tool.moveElements(clipboard, pasted_path, 0, copy=1)
+        tool.deleteElements(['%s/%s' % (pasted_path, id)
+                             for id in pasted.objectIds()])
+
+    def copies():
+        copiesOf([aq_base(element) for element
+                  in page.filled_slots.slot_0.objectValues()])
+
+    res = [('render', render)]
+    names = _uis.keys()
+    names.sort()
+    for name in names:
+        def design(name=name):
+            newRequest(root)
+            page.design(name)
+        res.append(('design:%s' % name, design))
+    res.extend([('getManifest', manifest), ('getSlotSpecs', slot_specs),
+                ('copiesOf', copies), ('paste', paste),
+                ('moveElements', move)])
+    res.extend(listInjectionBenchmarks())
+    return res
+
+
+def listInjectionBenchmarks(sizes=(100000, 1000000, 5000000)):
+    """Returns [(name, operation)] for placing the design fragments.
+
+    Compares the single-pass injection of CommonUI with the splicing
+    used up to 1.0, on large pages of the given sizes.
+    """
+    ui = FakeUI()
+    fragments = ui.getFragments(None)
+    res = []
+    for size in sizes:
+        text = make_page(size)
+        def inject(text=text):
+            ui.render(lambda: text)
+        def splice(text=text):
+            splice_fragments(text, fragments)
+        label = '%dKB' % (size // 1000)
+        res.extend([('inject:%s' % label, inject),
+                    ('splice:%s' % label, splice)])
+    return res
+
+
+def measure(op, seconds):
+    """Returns (operations per second, objects left per operation).
+    """
+    op()  # Warm up
+    gc.collect()
+    before = len(gc.get_objects())
+    count = 0
+    start = time.time()
+    elapsed = 0.0
+    while elapsed < seconds:
+        op()
+        count += 1
+        elapsed = time.time() - start
+    gc.collect()
+    left = len(gc.get_objects()) - before
+    return count / elapsed, float(left) / count
+
+
+def compare(results, baseline, tolerance):
+    """Prints the change of each result.  Returns the regressions.
+
+    Operations in the baseline that have no result now, because they
+    failed or no longer exist, count as regressions.
+    """
+    regressions = []
+    print
+    print '%-20s %12s %12s %8s' % ('', 'baseline', 'now', 'change')
+    current = dict(results)
+    names = baseline.keys()
+    names.sort()
+    for name in names:
+        if not current.has_key(name):
+            regressions.append(name)
+            print '%-20s %12.1f %12s %8s  MISSING' % (
+                name, baseline[name]['ops_per_sec'], '-', '')
+    for name, now in results:
+        old = baseline.get(name)
+        if old is None:
+            continue
+        change = now['ops_per_sec'] / old['ops_per_sec'] - 1.0
+        flag = ''
+        if change < -tolerance:
+            regressions.append(name)
+            flag = '  SLOWER'
+        print '%-20s %12.1f %12.1f %+7.1f%%%s' % (
+            name, old['ops_per_sec'], now['ops_per_sec'], change * 100, flag)
+    return regressions
+
+
+def main(args=None):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--slots', type='int', default=5,
+                      help='slots per composite (default 5)')
+    parser.add_option('--elements', type='int', default=10,
+                      help='elements per slot (default 10)')
+    parser.add_option('--depth', type='int', default=2,
+                      help='levels of nested composites (default 2)')
+    parser.add_option('--seconds', type='float', default=1.0,
+                      help='time to spend on each operation (default 1)')
+    parser.add_option('--save-baseline', dest='save', metavar='FILE',
+                      help='write the results to a JSON file')
+    parser.add_option('--compare', metavar='FILE',
+                      help='compare with the results in a JSON file')
+    parser.add_option('--tolerance', type='float', default=0.2,
+                      help='allowed slowdown when comparing (default 0.2)')
+    options, args = parser.parse_args(args)
+
+    setUp()
+    try:
+        root = Root()
+        root.composite_tool = CompositeTool()
+        root.composite_tool._check_security = 0
+        newRequest(root)
+        page = buildComposite(root, 'page', options.slots, options.elements,
+                              options.depth)
+        params = {'slots': options.slots, 'elements': options.elements,
+                  'depth': options.depth}
+        print '%(slots)d slots x %(elements)d elements, depth %(depth)d' % (
+            params)
+        print '%-20s %12s %12s' % ('', 'ops/sec', 'objs/op')
+        results = []
+        failures = []
+        for name, op in listBenchmarks(root, page):
+            try:
+                ops, objs = measure(op, options.seconds)
+            except Exception, e:
+                print '%-20s failed: %s: %s' % (name, e.__class__.__name__, e)
+                failures.append(name)
+                continue
+            print '%-20s %12.1f %12.2f' % (name, ops, objs)
+            results.append(
+                (name, {'ops_per_sec': ops, 'objects_per_op': objs}))
+    finally:
+        cleanUp()
+
+    status = 0
+    if failures:
+        print
+        print 'Failed: %s' % ', '.join(failures)
+        status = 1
+    if options.compare:
+        f = open(options.compare)
+        try:
+            baseline = json.load(f)
+        finally:
+            f.close()
+        if baseline['params'] != params:
+            print 'Warning: the baseline was made with %r' % (
+                baseline['params'],)
+        if compare(results, baseline['results'], options.tolerance):
+            status = 1
+    if options.save:
+        f = open(options.save, 'w')
+        try:
+            json.dump({'params': params, 'results': dict(results),
+                       'failed': failures}, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
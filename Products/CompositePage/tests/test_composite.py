@@ -16,7 +16,13 @@
 $Id: test_composite.py,v 1.6 2004/05/03 16:02:40 sidnei Exp $
 """
 
+import re
+import threading
+import time
 import unittest
+from cgi import parse_qsl
+from OFS.Folder import Folder
+from OFS.SimpleItem import SimpleItem
 from zope.testing.cleanup import cleanUp
 
 
@@ -30,11 +36,73 @@ template_text = '''\
 </html>
 '''
 
+static_template_text = '''\
+<html>
+<body>
+<div tal:replace="structure slot: slot_a (top) 'Top News Stories'">slot_a</div>
+<span tal:replace="structure slot: slot_b 'Other News'">slot_b</span>
+</body>
+</html>
+'''
+
+
+class Root(Folder):
+    """Stored root folder"""
+
+    def getPhysicalPath(self):
+        return ('',)
+
+    def getPhysicalRoot(self):
+        return self
+
+
+def esi_process(root, text):
+    # Stands in for an ESI proxy: replaces the include tags with the
+    # fragments they refer to.
+    def include(match):
+        url, query = match.group(1).replace('&amp;', '&').split('?')
+        path = url[len('http://localhost:8080/'):]
+        return root.unrestrictedTraverse(path)(**dict(parse_qsl(query)))
+    return re.sub(r'<esi:include src="([^"]*)" />', include, text)
+
+
+# Blocked ThreadNames render once this is set.
+release = threading.Event()
+
+
+class ThreadName(SimpleItem):
+    """Renders as the name of the thread that renders it"""
+
+    blocked = 0
+
+    def __init__(self, id, blocked=0):
+        self.id = id
+        self.blocked = blocked
+
+    def __call__(self):
+        if self.blocked:
+            release.wait(10)
+        return threading.currentThread().getName()
+
+
+class DenyingSecurityPolicy:
+    """Denies access to objects with one name"""
+
+    def __init__(self, name):
+        self.name = name
+
+    def validate(self, accessed, container, name, value, *args, **kw):
+        return name != self.name
+
+    def checkPermission(*args, **kw):
+        return 1
+
 
 class CompositeTests(unittest.TestCase):
 
     def setUp(self):
         cleanUp()
+        release.clear()
         from AccessControl.SecurityManagement import noSecurityManager
         from AccessControl.SecurityManager import setSecurityPolicy
         from Products.CompositePage.tests.test_tool import PermissiveSecurityPolicy
@@ -97,6 +165,54 @@ class CompositeTests(unittest.TestCase):
                     '</body></html>')
         self.assertTextEqual(rendered, expected)
 
+    def testStreamElements(self):
+        from Products.CompositePage.tests.test_designuis import FakeResponse
+        self._registerTraversable()
+        composite = self._make_composite()
+        inline = composite()
+        # While streaming, elements are rendered when the response
+        # reaches them.
+        composite._v_deferred = {}
+        try:
+            shell = composite()
+            self.assertFalse('Slot A' in shell)
+            response = FakeResponse()
+            composite._writeChunks([shell], response)
+        finally:
+            composite._v_deferred = None
+        self.assertEqual(response.written[1], '<b>Slot A</b>')
+        self.assertEqual(''.join(response.written), inline)
+
+    def testESI(self):
+        from ZPublisher.HTTPRequest import HTTPRequest
+        from ZPublisher.HTTPResponse import HTTPResponse
+        self._registerTraversable()
+        composite = self._make_composite()
+        f = composite.aq_parent
+        inline = composite()
+        composite.use_esi = 1
+        # Elements are rendered inline unless a proxy announces
+        # support for ESI.
+        self.assertEqual(composite(), inline)
+        f.REQUEST = HTTPRequest('', dict(
+            HTTP_HOST='localhost:8080',
+            HTTP_SURROGATE_CAPABILITY='proxy="ESI/1.0"'), HTTPResponse())
+        shell = composite()
+        self.assertTrue('<esi:include src="http://localhost:8080/composite/'
+                        'filled_slots/slot_a/e1/renderFragment'
+                        '?class_name=top" />' in shell)
+        response = f.REQUEST.RESPONSE
+        self.assertEqual(response.getHeader('Surrogate-Control'),
+                         'content="ESI/1.0"')
+        self.assertEqual(esi_process(f, shell), inline)
+        self.assertEqual(response.getHeader('Cache-Control'),
+                         'private, no-cache')
+        # Fragments carry the cache lifetime of their element.
+        composite.filled_slots.slot_a.e1.cache_ttl = 60
+        esi_process(f, shell)
+        self.assertEqual(response.getHeader('Cache-Control'),
+                         'public, max-age=60')
+
     def testGetManifest(self):
         self._registerTraversable()
         manifest = self._make_composite().getManifest()
@@ -147,6 +263,580 @@ class CompositeTests(unittest.TestCase):
         self.assertRaises(
             KeyError, composite.getSlotClassName, 'nonexistent_slot')
 
+    _tid = 0
+
+    def _fakeCommit(self, *obs):
+        # Give objects the oid and serial they would get from a commit.
+        from Acquisition import aq_base
+        self._tid += 1
+        for ob in obs:
+            ob = aq_base(ob)
+            if ob._p_oid is None:
+                ob._p_oid = '%08x' % (id(ob) & 0xffffffff)
+            ob._p_serial = '%08d' % self._tid
+
+    def testRenderCache(self):
+        self._registerTraversable()
+        composite = self._make_composite()
+        composite.render_cache_enabled = 1
+        f = composite.aq_parent
+        slot_a = composite.filled_slots.slot_a
+        inputs = (composite.template, composite, composite.filled_slots,
+                  slot_a, slot_a.e1, f.a1)
+        # Unsaved objects are never cached.
+        self.assertFalse(composite() is composite())
+        self._fakeCommit(*inputs)
+        first = composite()
+        self.assertTrue(composite() is first)
+        # A change to the referenced object invalidates the page.
+        self._fakeCommit(f.a1)
+        second = composite()
+        self.assertFalse(second is first)
+        self.assertTrue(composite() is second)
+        # So does editing.
+        composite._v_editing = 1
+        try:
+            self.assertFalse(composite() is second)
+        finally:
+            composite._v_editing = 0
+
+    def testRenderCacheFileTemplate(self):
+        # Templates read from files are not saved, but still cache.
+        import os
+        import tempfile
+        from Products.PageTemplates.PageTemplateFile import PageTemplateFile
+        self._registerTraversable()
+        composite = self._make_composite()
+        composite.render_cache_enabled = 1
+        fd, fn = tempfile.mkstemp('.pt')
+        try:
+            os.write(fd, template_text)
+            os.close(fd)
+            composite.template = PageTemplateFile(fn)
+            slot_a = composite.filled_slots.slot_a
+            self._fakeCommit(composite, composite.filled_slots, slot_a,
+                             slot_a.e1, composite.aq_parent.a1)
+            first = composite()
+            self.assertTrue(composite() is first)
+            # A changed file invalidates the page once it is reloaded.
+            f = open(fn, 'w')
+            f.write(template_text.replace('<html>', '<html><!-- 2 -->'))
+            f.close()
+            mtime = os.path.getmtime(fn) + 10
+            os.utime(fn, (mtime, mtime))
+            self.assertTrue(composite() is first)
+            # Reload, as in debug mode.
+            composite.template._v_last_read = 0
+            second = composite()
+            self.assertTrue('<!-- 2 -->' in second)
+            self.assertTrue(composite() is second)
+        finally:
+            os.remove(fn)
+
+    def testPageTTLNested(self):
+        from Products.CompositePage.composite import Composite
+        from Products.CompositePage.element import CompositeElement
+        from Products.CompositePage.slot import Slot
+        from Products.PageTemplates.ZopePageTemplate import ZopePageTemplate
+        self._registerTraversable()
+        composite = self._make_composite()
+        f = composite.aq_parent
+        slot_a = composite.filled_slots.slot_a
+        slot_a.e1.cache_ttl = 60
+        f.inner = Composite()
+        f.inner._setId("inner")
+        f.inner.template = ZopePageTemplate(
+            id="template", text=template_text, content_type="text/html")
+        f.inner.filled_slots.slot_a = inner_slot = Slot("slot_a")
+        e2 = CompositeElement('e2', f.a1)
+        e2.cache_ttl = 30
+        inner_slot._setObject(e2.id, e2)
+        e3 = CompositeElement('e3', f.inner)
+        e3.cache_ttl = 120
+        slot_a._setObject(e3.id, e3)
+        # The elements of the inner composite count.
+        template = composite.getTemplate()
+        self.assertEqual(composite._getPageTTL(template), 30)
+        inner_slot.e2.cache_ttl = 0
+        self.assertEqual(composite._getPageTTL(template), 0)
+        # Slots are left alone.
+        self.assertFalse(slot_a.__dict__.has_key('_v_class_name'))
+
+    def testCachePolicy(self):
+        from ZPublisher.HTTPRequest import HTTPRequest
+        from ZPublisher.HTTPResponse import HTTPResponse
+        self._registerTraversable()
+        composite = self._make_composite()
+        f = composite.aq_parent
+        e1 = composite.filled_slots.slot_a.e1
+
+        def publish(**headers):
+            environ = dict(HTTP_HOST='localhost:8080')
+            for name, value in headers.items():
+                environ['HTTP_' + name.upper()] = value
+            f.REQUEST = HTTPRequest('', environ, HTTPResponse())
+            f.REQUEST['PUBLISHED'] = composite
+            return composite(), f.REQUEST.RESPONSE
+
+        # Elements are not cacheable by default.
+        text, response = publish()
+        self.assertEqual(response.getHeader('Cache-Control'),
+                         'private, no-cache')
+        self.assertEqual(response.getHeader('ETag'), None)
+        e1.cache_ttl = 60
+        self._fakeCommit(composite.template, composite,
+                         composite.filled_slots, composite.filled_slots.slot_a,
+                         e1, f.a1)
+        text, response = publish()
+        self.assertEqual(response.getHeader('Cache-Control'),
+                         'public, max-age=60')
+        self.assertTrue(response.getHeader('Expires'))
+        etag = response.getHeader('ETag')
+        self.assertTrue(etag)
+        # A conditional GET is answered without rendering.
+        self.assertEqual(publish(if_none_match=etag)[0], '')
+        self.assertEqual(f.REQUEST.RESPONSE.status, 304)
+        self.assertEqual(f.REQUEST.RESPONSE.getHeader('Cache-Control'),
+                         'public, max-age=60')
+        self._fakeCommit(f.a1)
+        text, response = publish(if_none_match=etag)
+        self.assertTrue('Slot A' in text)
+        self.assertEqual(response.status, 200)
+        # A timeout in an earlier rendering does not matter.
+        composite._v_timed_out = 1
+        text, response = publish()
+        self.assertEqual(response.getHeader('Cache-Control'),
+                         'public, max-age=60')
+        # With Edge Side Includes, the page has a lifetime of its own.
+        composite.use_esi = 1
+        esi = 'proxy="ESI/1.0"'
+        text, response = publish(surrogate_capability=esi)
+        self.assertEqual(response.getHeader('Cache-Control'),
+                         'private, no-cache')
+        composite.esi_shell_ttl = 300
+        text, response = publish(surrogate_capability=esi)
+        self.assertEqual(response.getHeader('Cache-Control'),
+                         'public, max-age=300')
+        composite.use_esi = 0
+        # Composites rendered inside another page set no headers.
+        f.REQUEST = HTTPRequest('', dict(HTTP_HOST='localhost:8080'),
+                                HTTPResponse())
+        composite()
+        self.assertEqual(f.REQUEST.RESPONSE.getHeader('Cache-Control'), None)
+
+    def testFragmentCache(self):
+        self._registerTraversable()
+        composite = self._make_composite()
+        f = composite.aq_parent
+        e1 = composite.filled_slots.slot_a.e1
+        e1.cache_ttl = 60
+        self.assertTrue("Slot A" in e1.renderInline())
+        # Unsaved targets are rendered every time.
+        f.a1.pt_edit("<b>Changed</b>", "text/html")
+        self.assertTrue("Changed" in e1.renderInline())
+        self._fakeCommit(f.a1)
+        self.assertTrue("Changed" in e1.renderInline())
+        f.a1.pt_edit("<b>Not committed</b>", "text/html")
+        self.assertTrue("Changed" in e1.renderInline())
+        self._fakeCommit(f.a1)
+        self.assertTrue("Not committed" in e1.renderInline())
+        # Without a TTL, the cache is bypassed.
+        e1.cache_ttl = 0
+        f.a1.pt_edit("<b>Uncached</b>", "text/html")
+        self.assertTrue("Uncached" in e1.renderInline())
+
+    def testFragmentCachePerUser(self):
+        from AccessControl.SecurityManagement import newSecurityManager
+        from AccessControl.SecurityManagement import noSecurityManager
+        from AccessControl.User import SimpleUser
+        self._registerTraversable()
+        composite = self._make_composite()
+        f = composite.aq_parent
+        e1 = composite.filled_slots.slot_a.e1
+        e1.cache_ttl = 60
+        f.a1.pt_edit('<b tal:content="user/getUserName">user</b>',
+                     "text/html")
+        self._fakeCommit(f.a1)
+        try:
+            for name in ('bob', 'alice'):
+                newSecurityManager(None, SimpleUser(name, '', ['Member'], []))
+                self.assertTrue(name in e1.renderInline())
+            # Anonymous users share an entry.
+            noSecurityManager()
+            text = e1.renderInline()
+            self.assertTrue("Anonymous User" in text)
+            self.assertTrue(e1.renderInline() is text)
+        finally:
+            noSecurityManager()
+
+    def testDefaultInlineTemplate(self):
+        from Products.PageTemplates.ZopePageTemplate import ZopePageTemplate
+        from Products.CompositePage.tool import CompositeTool
+        self._registerTraversable()
+        composite = self._make_composite()
+        f = composite.aq_parent
+        f._setObject('composite_tool', CompositeTool())
+        f._setObject('inline', ZopePageTemplate(
+            id='inline', text='<i tal:content="context/getId">x</i>'))
+        f.composite_tool.default_inline_templates = ('missing', 'inline')
+        e1 = composite.filled_slots.slot_a.e1
+        templates = e1.listAllowableInlineTemplates()
+        self.assertEqual([name for name, t in templates], ['inline'])
+        self.assertTextEqual(e1.renderInline(), '<i>a1</i>')
+        # The choice is remembered for objects of the same kind...
+        f._setObject('missing', ZopePageTemplate(
+            id='missing', text='<u>m</u>'))
+        self.assertTextEqual(e1.renderInline(), '<i>a1</i>')
+        # ...until the list of templates changes.
+        f.composite_tool.default_inline_templates = ('missing',)
+        self.assertTextEqual(e1.renderInline(), '<u>m</u>')
+
+    def testGetSlotSpecsWithoutRendering(self):
+        self._registerTraversable()
+        composite = self._make_composite()
+        composite.template.pt_edit(static_template_text, "text/html")
+        rendered = []
+        e1 = composite.filled_slots.slot_a.e1
+        e1.renderInline = lambda: rendered.append(1) or ''
+        specs = composite.getSlotSpecs()
+        self.assertEqual(rendered, [])
+        self.assertEqual(specs, [
+            {'name': 'slot_a', 'class_name': 'top',
+             'title': 'Top News Stories'},
+            {'name': 'slot_b', 'class_name': None, 'title': 'Other News'},
+            ])
+        # Slots used only by the template are stored, like a rendering
+        # in editing mode would, so that elements can be added.
+        self.assertTrue(composite.filled_slots.hasObject('slot_b'))
+        manifest = composite.getManifest()
+        self.assertEqual(manifest[1]['target_path'],
+                         'composite/filled_slots/slot_b')
+        # Editing the template replaces the cached specs.
+        composite.template.pt_edit(template_text, "text/html")
+        specs = composite.getSlotSpecs()
+        self.assertEqual(rendered, [1])
+        self.assertEqual([spec['name'] for spec in specs],
+                         ['slot_a', 'slot_b', 'slot_c'])
+
+    def testSlotSpecLookupsRenderOnce(self):
+        # The template finds slot_c dynamically, so learning its slots
+        # requires a rendering, but only one per request.
+        self._registerTraversable()
+        composite = self._make_composite()
+        rendered = []
+        e1 = composite.filled_slots.slot_a.e1
+        e1.renderInline = lambda: rendered.append(1) or ''
+        for i in range(10):
+            self.assertEqual(composite.getSlotClassName('slot_a'), 'top')
+            self.assertEqual(composite.getSlotClassName('slot_c'), None)
+        self.assertEqual(len(composite.getManifest()), 3)
+        self.assertEqual(composite.getSlotSpecIndex(), {
+            'slot_a': ('top', 'Top News Stories'),
+            'slot_b': (None, 'Other News'),
+            'slot_c': (None, None),
+            })
+        self.assertEqual(rendered, [1])
+
+    def testBatchDereference(self):
+        from OFS.Folder import Folder
+        from Products.PageTemplates.ZopePageTemplate import ZopePageTemplate
+        from Products.CompositePage.element import CompositeElement
+        from Products.CompositePage.element import resolvePaths
+        self._registerTraversable()
+        composite = self._make_composite()
+        root = composite.aq_parent
+        root.getPhysicalPath = lambda: ('',)
+        root._setObject('news', Folder('news'))
+        for id in ('a', 'b'):
+            root.news._setObject(id, ZopePageTemplate(id=id, text=id))
+        slot_a = composite.filled_slots.slot_a
+        for id in ('a', 'b'):
+            slot_a._setObject('e_' + id, CompositeElement('e_' + id, root.a1))
+            slot_a._getOb('e_' + id).path = '/news/' + id
+        traversed = []
+
+        def counting(ob):
+            def restrictedTraverse(path, default=None):
+                traversed.append(path)
+                return Folder.restrictedTraverse(ob, path)
+            return restrictedTraverse
+
+        root.restrictedTraverse = counting(root)
+        root.news.restrictedTraverse = counting(root.news)
+        res = resolvePaths(composite, ['/news/a', '/news/b', '/news/x', 'a1'])
+        self.assertEqual(sorted(res.keys()), ['/news/a', '/news/b'])
+        self.assertEqual(res['/news/a'].getPhysicalPath(), ('', 'news', 'a'))
+        # The shared prefix is traversed once.
+        self.assertEqual(sorted(traversed), ['a', 'b', 'news', 'x'])
+        # Rendering fills the dereference cache for the request, so
+        # later dereferencing does not traverse again.
+        composite()
+        del traversed[:]
+        self.assertEqual(slot_a.e_b.dereference().getId(), 'b')
+        composite.getManifest()
+        self.assertEqual(traversed, [])
+
+    def testDereferenceCachePerSecurityContext(self):
+        from AccessControl import getSecurityManager
+        from Products.CompositePage.element import getDereferenceCache
+        composite = self._make_composite()
+        cache = getDereferenceCache(composite)
+        self.assertTrue(getDereferenceCache(composite) is cache)
+        # A script with proxy roles traverses with other rights.
+        script = SimpleItem()
+        script._proxy_roles = ('Manager',)
+        sm = getSecurityManager()
+        sm.addContext(script)
+        try:
+            self.assertFalse(getDereferenceCache(composite) is cache)
+        finally:
+            sm.removeContext(script)
+        self.assertTrue(getDereferenceCache(composite) is cache)
+
+    def testResolveByOid(self):
+        import transaction
+        from ZODB.DB import DB
+        from ZODB.DemoStorage import DemoStorage
+        from AccessControl.SecurityManagement import noSecurityManager
+        from AccessControl.SecurityManager import setSecurityPolicy
+        from zExceptions import Unauthorized
+        from Products.PageTemplates.ZopePageTemplate import ZopePageTemplate
+        from Products.CompositePage.element import CompositeElement
+        db = DB(DemoStorage())
+        conn = db.open()
+        try:
+            conn.root()['Application'] = Root('app')
+            app = conn.root()['Application']
+            app._setObject('news', Folder('news'))
+            a = ZopePageTemplate(id='a', text='A')
+            app.news._setObject('a', a)
+            app._setObject('e', CompositeElement('e', app.news.a))
+            e = app.e
+            transaction.commit()
+            # Turning the property on (or editing the path) remembers
+            # the OIDs.
+            e.manage_changeProperties(resolve_by_oid=1)
+            self.assertEqual(e._target_oids, (('news', app.news._p_oid),
+                                              ('a', a._p_oid)))
+            transaction.commit()
+
+            def traverse(path, default=None):
+                raise AssertionError("Traversed %s" % path)
+            e.restrictedTraverse = traverse
+            ob = e.dereference()
+            self.assertTrue(ob.aq_base is a)
+            self.assertEqual(ob.getPhysicalPath(), ('', 'news', 'a'))
+            del e.restrictedTraverse
+            # Each container is checked.
+            policy = setSecurityPolicy(DenyingSecurityPolicy('news'))
+            noSecurityManager()
+            try:
+                self.assertRaises(Unauthorized, e.dereference)
+            finally:
+                setSecurityPolicy(policy)
+                noSecurityManager()
+            # When the target is replaced, the element falls back to
+            # the path.  Rendering never writes to the element...
+            app.news._delOb('a')
+            b = ZopePageTemplate(id='a', text='B')
+            app.news._setOb('a', b)
+            transaction.commit()
+            self.assertTrue(e.dereference().aq_base is b)
+            self.assertEqual(e._target_oids[-1], ('a', a._p_oid))
+            self.assertFalse(e._p_changed)
+            # ...but the new OIDs are recorded once the transaction
+            # commits.
+            transaction.commit()
+            transaction.begin()
+            self.assertEqual(e._target_oids[-1], ('a', b._p_oid))
+            e.restrictedTraverse = traverse
+            self.assertTrue(e.dereference().aq_base is b)
+            del e.restrictedTraverse
+            # Editing the path records the OIDs as well.
+            c = ZopePageTemplate(id='c', text='C')
+            app.news._setObject('c', c)
+            e.manage_changeProperties(path='/news/c')
+            self.assertEqual(e._target_oids[-1], ('c', c._p_oid))
+        finally:
+            transaction.abort()
+            conn.close()
+            db.close()
+
+    def testRenderConcurrently(self):
+        import transaction
+        from ZODB.DB import DB
+        from ZODB.DemoStorage import DemoStorage
+        from Products.CompositePage.composite import Composite
+        from Products.CompositePage.element import CompositeElement
+        from Products.CompositePage.slot import Slot
+        from Products.CompositePage.slot import timeout_tag
+        from Products.CompositePage.tool import CompositeTool
+        from Products.CompositePage.parallel import getPool
+        db = DB(DemoStorage())
+        conn = db.open()
+        try:
+            conn.root()['Application'] = Root('app')
+            app = conn.root()['Application']
+            app._setObject('composite_tool', CompositeTool())
+            app._setObject('composite', Composite())
+            app.composite.filled_slots._setObject('slot', Slot('slot'))
+            slot = app.composite.filled_slots.slot
+            app._setObject('fast', ThreadName('fast'))
+            app._setObject('slow', ThreadName('slow', blocked=1))
+            for id, target in (('e1', 'fast'), ('e2', 'fast'),
+                               ('e3', 'slow')):
+                e = CompositeElement(id, app._getOb(target))
+                e.template_name = 'call'
+                slot._setObject(id, e)
+            slot.e1.render_concurrently = 1
+            slot.e3.render_concurrently = 1
+            transaction.commit()
+            main = threading.currentThread().getName()
+            app.composite_tool.render_timeout = 0.2
+            texts = slot.multiple()[1:]
+            self.assertEqual(texts, [
+                '<div>\nCompositeRenderer\n</div>',
+                '<div>\n%s\n</div>' % main,
+                '<div>\n%s\n</div>' % timeout_tag,
+                ])
+            # Elements with changes that are not committed yet are
+            # rendered in this thread.
+            slot.e1._p_changed = 1
+            self.assertEqual(slot.multiple()[1],
+                             '<div>\n%s\n</div>' % main)
+            # Let the slow rendering finish before closing the database.
+            release.set()
+            getPool(app.composite_tool.render_threads).join()
+        finally:
+            transaction.abort()
+            conn.close()
+            db.close()
+
+    def testCloneRequest(self):
+        from ZPublisher.HTTPRequest import HTTPRequest
+        from ZPublisher.HTTPResponse import HTTPResponse
+        from Products.CompositePage.parallel import cloneRequest
+        environ = dict(HTTP_HOST='localhost:8080', REQUEST_METHOD='GET',
+                       QUERY_STRING='a=1', HTTP_COOKIE='session=abc')
+        request = HTTPRequest(None, environ, HTTPResponse())
+        request.processInputs()
+        f = Folder('f')
+        request['PARENTS'] = [f]
+        request['PUBLISHED'] = f.manage_main
+        request['skin'] = 'Plain'
+        request['folder'] = f
+        request[('composite_dereference', None)] = {'/f': f}
+        clone = cloneRequest(request)
+        self.assertEqual(clone.form, {'a': '1'})
+        self.assertEqual(clone.cookies, {'session': 'abc'})
+        self.assertEqual(clone['a'], '1')
+        self.assertEqual(clone['skin'], 'Plain')
+        self.assertEqual(clone['URL'], request['URL'])
+        # Objects of the request's own thread are not shared.
+        for key in ('PARENTS', 'PUBLISHED', 'folder',
+                    ('composite_dereference', None)):
+            self.assertFalse(clone.other.has_key(key))
+        self.assertFalse(clone.response is request.response)
+
+    def testThreadPool(self):
+        from ZODB.POSException import ReadConflictError
+        from Products.CompositePage.parallel import ThreadPool
+        pool = ThreadPool(1, max_queued=2)
+        now = time.time()
+        blocked = pool.submit(now + 10, release.wait, 10)
+        # The only thread waits for blocked; the queue takes two calls.
+        while pool._queue.qsize():
+            time.sleep(0.01)
+        expired = pool.submit(now, lambda: 'late')
+        def conflict():
+            raise ReadConflictError
+        failing = pool.submit(now + 10, conflict)
+        self.assertEqual(pool.submit(now + 10, lambda: 'full'), None)
+        release.set()
+        self.assertEqual(blocked.wait(now + 10), (1, True))
+        # Calls that could not start before their deadline are skipped.
+        self.assertEqual(expired.wait(now + 10), (1, None))
+        # Conflicts reach the waiting thread.
+        self.assertRaises(ReadConflictError, failing.wait, now + 10)
+
+    def testRenderTimeout(self):
+        import transaction
+        from ZODB.DB import DB
+        from ZODB.DemoStorage import DemoStorage
+        from Products.CompositePage.composite import Composite
+        from Products.CompositePage.element import CompositeElement
+        from Products.CompositePage.slot import Slot
+        from Products.CompositePage.slot import timeout_tag
+        from Products.CompositePage.tool import CompositeTool
+        from Products.CompositePage.parallel import getPool
+        db = DB(DemoStorage())
+        conn = db.open()
+        try:
+            conn.root()['Application'] = Root('app')
+            app = conn.root()['Application']
+            app._setObject('composite_tool', CompositeTool())
+            app._setObject('composite', Composite())
+            app.composite.filled_slots._setObject('slot', Slot('slot'))
+            slot = app.composite.filled_slots.slot
+            app._setObject('target', ThreadName('target'))
+            e = CompositeElement('e', app.target)
+            e.template_name = 'call'
+            e.render_timeout = 0.2
+            slot._setObject('e', e)
+            transaction.commit()
+            good = '<div>\nCompositeRenderer\n</div>'
+            self.assertEqual(slot.multiple()[1:], [good])
+            # When the element runs out of time, the page shows the
+            # last good rendering.
+            app.target.blocked = 1
+            transaction.commit()
+            self.assertEqual(slot.multiple()[1:], [good])
+            from Products.CompositePage.slot import _last_good
+            _last_good.clear()
+            self.assertEqual(slot.multiple()[1:],
+                             ['<div>\n%s\n</div>' % timeout_tag])
+            # Elements are not rendered at all once the composite
+            # runs out of time.
+            slot.e.render_timeout = 0.0
+            app.composite._v_render_deadline = time.time() - 1
+            self.assertEqual(slot.multiple()[1:],
+                             ['<div>\n%s\n</div>' % timeout_tag])
+            self.assertEqual(app.composite._v_timed_out, 1)
+            # The budget also limits the wait for an element with a
+            # longer timeout.
+            slot.e.render_timeout = 10.0
+            start = time.time()
+            app.composite._v_render_deadline = start + 0.2
+            self.assertEqual(slot.multiple()[1:],
+                             ['<div>\n%s\n</div>' % timeout_tag])
+            self.assertTrue(time.time() - start < 5)
+            release.set()
+            getPool(app.composite_tool.render_threads).join()
+        finally:
+            transaction.abort()
+            conn.close()
+            db.close()
+
+    def testLastGoodPerUser(self):
+        from AccessControl.SecurityManagement import newSecurityManager
+        from AccessControl.SecurityManagement import noSecurityManager
+        from AccessControl.User import SimpleUser
+        composite = self._make_composite()
+        slot = composite.filled_slots.slot_a
+        keys = []
+        for name in ('bob', 'alice', None, None):
+            if name is None:
+                noSecurityManager()
+            else:
+                newSecurityManager(None, SimpleUser(name, '', ['Member'], []))
+            keys.append(slot._getLastGoodKey(slot.e1))
+        noSecurityManager()
+        # Users with the same roles don't share renderings, but
+        # anonymous users do.
+        self.assertNotEqual(keys[0], keys[1])
+        self.assertEqual(keys[2], keys[3])
+
+
 def test_suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(CompositeTests))
@@ -0,0 +1,214 @@
+##############################################################################
+#
+# Copyright (c) 2011 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.0 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Design UI tests.
+
+$Id$
+"""
+
+import re
+import unittest
+
+from zope.testing.cleanup import cleanUp
+
+from Products.CompositePage.designuis import CommonUI
+from Products.CompositePage.designuis import findInsertionPoints
+
+
+page_text = '''\
+<html>
+<head><title>Page</title></head>
+<body class="x">
+<p>Content</p>
+</body>
+</html>
+'''
+
+
+def splice_fragments(text, fragments):
+    # The fragment injection used by CommonUI.render up to 1.0.
+    start_of_head_search = re.compile("(<head[^>]*>)", re.IGNORECASE).search
+    start_of_body_search = re.compile("(<body[^>]*>)", re.IGNORECASE).search
+    end_of_body_search = re.compile("(</body[^>]*>)", re.IGNORECASE).search
+    match = start_of_head_search(text)
+    index = match.end(0)
+    text = "%s%s%s" % (text[:index], fragments['header'], text[index:])
+    match = start_of_body_search(text)
+    index = match.end(0)
+    text = "%s%s%s" % (text[:index], fragments['top'], text[index:])
+    match = end_of_body_search(text)
+    m = match
+    while m is not None:
+        match = m
+        m = end_of_body_search(text, match.end(0))
+    index = match.start(0)
+    text = "%s%s%s" % (text[:index], fragments['bottom'], text[index:])
+    return text
+
+
+def make_page(size):
+    row = '<div class="element"><p>Some <b>text</b></p></div>\n'
+    return '<html>\n<head>\n</head>\n<BODY>\n%s</body>\n</html>\n' % (
+        row * (size // len(row)))
+
+
+class FakeUI(CommonUI):
+
+    def getFragments(self, composite):
+        return {"header": "<HEADER/>", "top": "<TOP/>", "bottom": "<BOTTOM/>"}
+
+
+class FakeResponse:
+
+    def __init__(self):
+        self.headers = {}
+        self.written = []
+
+    def getHeader(self, name):
+        return self.headers.get(name.lower())
+
+    def setHeader(self, name, value):
+        self.headers[name.lower()] = value
+
+    def write(self, data):
+        self.written.append(data)
+
+
+class CountingTemplate:
+    """Stands in for a PageTemplateFile and counts its renderings."""
+
+    _v_last_read = 0
+
+    def __init__(self, text):
+        self.text = text
+        self.rendered = 0
+
+    def _cook_check(self):
+        pass
+
+    def __of__(self, parent):
+        return self
+
+    def __call__(self, **kw):
+        self.rendered += 1
+        return self.text
+
+
+class CommonUITests(unittest.TestCase):
+
+    def setUp(self):
+        cleanUp()
+
+    def tearDown(self):
+        cleanUp()
+
+    def makeUI(self, klass):
+        from OFS.Folder import Folder
+        tool = Folder("composite_tool")
+        uis = Folder("uis").__of__(tool)
+        ui = klass()
+        ui._setId("ui")
+        return ui.__of__(uis), tool
+
+    def testRender(self):
+        text = FakeUI().render(lambda: page_text)
+        self.assertEqual(text, '''\
+<html>
+<head><HEADER/><title>Page</title></head>
+<body class="x"><TOP/>
+<p>Content</p>
+<BOTTOM/></body>
+</html>
+''')
+
+    def testRenderFragmentOnly(self):
+        text = FakeUI().render(lambda: "<p>Content</p>")
+        self.assertTrue(text.startswith("<html>\n<head><HEADER/>"))
+        self.assertTrue("<body><TOP/>\n<p>Content</p>\n<BOTTOM/></body>"
+                        in text)
+
+    def testStream(self):
+        from Products.CompositePage.composite import Composite
+        ui = FakeUI()
+        chunks = list(ui.renderChunks(lambda: page_text))
+        self.assertEqual(''.join(chunks), ui.render(lambda: page_text))
+        response = FakeResponse()
+        Composite()._writeChunks([u'caf\xe9', '', 'x'], response)
+        self.assertEqual(response.written, ['caf\xc3\xa9', 'x'])
+        self.assertEqual(response.headers['content-type'],
+                         'text/html; charset=utf-8')
+
+    def testFindInsertionPoints(self):
+        text = '<HTML><Head x="1"><BODY></Body><p>x</p></BoDy >\n</html>'
+        self.assertEqual(findInsertionPoints(text), (18, 24, 39))
+        self.assertEqual(findInsertionPoints('<p>x</p>'), (None, None, None))
+        self.assertEqual(findInsertionPoints('<head></body'),
+                         (6, None, None))
+
+    def testInjectionMatchesSplicing(self):
+        # The single-pass injection gives the same page as the old
+        # splicing.  tests/benchmark.py compares their speed.
+        ui = FakeUI()
+        fragments = ui.getFragments(None)
+        texts = [page_text, make_page(10000),
+                 '<HTML><HEAD></HEAD><Body>x</BODY><p/></body ></HTML>']
+        for text in texts:
+            self.assertEqual(ui.render(lambda: text),
+                             splice_fragments(text, fragments))
+
+    def testFragmentsCached(self):
+        from OFS.Folder import Folder
+        rendered = []
+
+        class CountingUI(CommonUI):
+            header_templates = top_templates = bottom_templates = ()
+
+            def _renderFragments(self, tool, composite):
+                rendered.append(composite.getId())
+                return {"header": [], "top": [], "bottom": []}
+
+        ui, tool = self.makeUI(CountingUI)
+        c1 = Folder("c1").__of__(tool)
+        c2 = Folder("c2").__of__(tool)
+        ui.getFragments(c1)
+        ui.getFragments(c1)
+        ui.getFragments(c2)
+        self.assertEqual(rendered, ["c1", "c2"])
+
+    def testUncachedTemplates(self):
+        from OFS.Folder import Folder
+        header = CountingTemplate("<HEADER/>")
+        tabs = CountingTemplate("<TABS/>")
+        top = CountingTemplate("<TOP/>")
+
+        class TabsUI(CommonUI):
+            header_templates = (header,)
+            top_templates = (tabs, top)
+            bottom_templates = ()
+            uncached_templates = (tabs,)
+
+        ui, tool = self.makeUI(TabsUI)
+        c = Folder("c").__of__(tool)
+        for i in range(3):
+            self.assertEqual(ui.getFragments(c), {
+                "header": "<HEADER/>", "top": "<TABS/><TOP/>", "bottom": ""})
+        self.assertEqual((header.rendered, tabs.rendered, top.rendered),
+                         (1, 3, 1))
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(CommonUITests))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,206 @@
+##############################################################################
+#
+# Copyright (c) 2011 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.0 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Slot ordering tests.
+
+$Id$
+"""
+
+import unittest
+
+from Products.CompositePage.ordering import Ordering
+
+
+def infos(*ids):
+    return tuple([{'id': id, 'meta_type': 'Element'} for id in ids])
+
+
+class OrderingTests(unittest.TestCase):
+
+    def testInsertAndMove(self):
+        o = Ordering(infos('a', 'b', 'c'))
+        o.insert(1, 'd', 'Element')
+        self.assertEqual(o.ids(), ['a', 'd', 'b', 'c'])
+        o.move('a', 3)
+        self.assertEqual(o.ids(), ['d', 'b', 'c', 'a'])
+        o.move('a', 0)
+        self.assertEqual(o.ids(), ['a', 'd', 'b', 'c'])
+        o.move('c', -1)
+        self.assertEqual(o.ids(), ['a', 'd', 'c', 'b'])
+        self.assertEqual(o.remove('d'), 'Element')
+        self.assertEqual(o.ids(), ['a', 'c', 'b'])
+        self.assertEqual(len(o), 3)
+        self.assertFalse(o.has_key('d'))
+        self.assertRaises(KeyError, o.append, 'a', 'Element')
+
+    def testFullGap(self):
+        # Inserting at the same place many times renumbers eventually.
+        o = Ordering(infos('a', 'b'))
+        for i in range(40):
+            o.insert(1, 'x%d' % i, 'Element')
+        expected = ['a'] + ['x%d' % i for i in range(39, -1, -1)] + ['b']
+        self.assertEqual(o.ids(), expected)
+
+    def testNullify(self):
+        o = Ordering(infos('a', 'b', 'c'))
+        o.nullify('a')
+        o.nullify('c')
+        self.assertEqual(o.ids(), ['null_element', 'b', 'null_element'])
+        o.insert(3, 'a', 'Element')
+        self.assertEqual(o.ids(), ['null_element', 'b', 'null_element', 'a'])
+        o.pack()
+        self.assertEqual(o.ids(), ['b', 'a'])
+        self.assertEqual(len(o), 2)
+
+    def testInsertAfter(self):
+        o = Ordering(infos('a', 'b', 'c'))
+        o.insertAfter('a', 'd', 'Element')
+        o.insertAfter(None, 'e', 'Element')
+        self.assertEqual(o.ids(), ['e', 'a', 'd', 'b', 'c'])
+        o.moveAfter('e', 'c')
+        o.moveAfter('b', None)
+        self.assertEqual(o.ids(), ['b', 'a', 'd', 'c', 'e'])
+        o.reset(infos('c', 'a'))
+        self.assertEqual(o.infos(), infos('c', 'a'))
+        self.assertEqual(len(o), 2)
+
+    def testUpdate(self):
+        o = Ordering(infos('a', 'b', 'c', 'd'))
+        positions = dict(o._index.items())
+        o.update(infos('a', 'd', 'b', 'c', 'e'))
+        self.assertEqual(o.ids(), ['a', 'd', 'b', 'c', 'e'])
+        # Only d moved; the others kept their positions.
+        for id in ('a', 'b', 'c'):
+            self.assertEqual(o._index[id], positions[id])
+        o.update(infos('d', 'b', 'e'))
+        self.assertEqual(o.infos(), infos('d', 'b', 'e'))
+        self.assertEqual(o._index['b'], positions['b'])
+        o._v_cache = None
+        self.assertEqual(o.ids(), ['d', 'b', 'e'])
+        self.assertEqual(len(o), 3)
+        o.update(infos('e', 'b', 'd'))
+        self.assertEqual(o.ids(), ['e', 'b', 'd'])
+
+    def testCache(self):
+        o = Ordering(infos('a', 'b'))
+        self.assertTrue(o.infos() is o.infos())
+        o.append('c', 'Element')
+        self.assertEqual(o.infos(), infos('a', 'b', 'c'))
+        # Another connection committed a change.
+        o._changes.change(1)
+        o._items[o._index['a']] = ('a', 'Other')
+        self.assertEqual(o.infos()[0]['meta_type'], 'Other')
+
+    def testConcurrentInserts(self):
+        # Inserts at the same place pick different positions, so the
+        # BTrees of two transactions can be merged.
+        positions = {}
+        for i in range(20):
+            o = Ordering(infos('a', 'b'))
+            o.insert(1, 'c', 'Element')
+            pos = o._index['c']
+            self.assertTrue(o._index['a'] < pos < o._index['b'])
+            positions[pos] = 1
+        self.assertTrue(len(positions) > 1)
+
+    def testSlotResolveConflict(self):
+        from ZODB.POSException import ConflictError
+        from Products.CompositePage.slot import Slot
+        slot = Slot('slot')
+        old = {'id': 'slot', 'a': 1, 'b': 2}
+        saved = {'id': 'slot', 'a': 1, 'b': 2, 'c': 3}
+        new = {'id': 'slot', 'b': 2, 'd': 4}
+        self.assertEqual(slot._p_resolveConflict(old, saved, new),
+                         {'id': 'slot', 'b': 2, 'c': 3, 'd': 4})
+        # Both transactions added an element with the same id.
+        new = {'id': 'slot', 'a': 1, 'b': 2, 'c': 5}
+        self.assertRaises(ConflictError, slot._p_resolveConflict,
+                          old, saved, new)
+
+    def testConcurrentSlotChanges(self):
+        # Two connections change the same slot; the commits merge.
+        import os
+        import shutil
+        import tempfile
+        import transaction
+        from ZODB.DB import DB
+        from ZODB.FileStorage import FileStorage
+        from OFS.Folder import Folder
+        from Products.CompositePage.slot import Slot
+        tmp = tempfile.mkdtemp()
+        db = DB(FileStorage(os.path.join(tmp, 'Data.fs')))
+        try:
+            tm1 = transaction.TransactionManager()
+            tm2 = transaction.TransactionManager()
+            conn1 = db.open(transaction_manager=tm1)
+            conn2 = db.open(transaction_manager=tm2)
+            slot1 = conn1.root()['slot'] = Slot('slot')
+            for id in ('a', 'b'):
+                slot1._setObject(id, Folder(id))
+            tm1.commit()
+            tm2.begin()
+            slot2 = conn2.root()['slot']
+            # An append and an insert at the front.
+            slot1._setObject('c', Folder('c'))
+            slot2._setObject('d', Folder('d'))
+            slot2.reorder('d', 0)
+            tm1.commit()
+            tm2.commit()
+            tm1.begin()
+            self.assertEqual(list(slot1.objectIds()), ['d', 'a', 'b', 'c'])
+            self.assertEqual(slot1.d.getId(), 'd')
+            # Two appends land after the same object.  Their positions
+            # are random, so they merge in either order.
+            tm2.begin()
+            slot1._setObject('e', Folder('e'))
+            slot2._setObject('f', Folder('f'))
+            tm1.commit()
+            tm2.commit()
+            tm1.begin()
+            ids = list(slot1.objectIds())
+            self.assertEqual(ids[:4], ['d', 'a', 'b', 'c'])
+            self.assertEqual(sorted(ids[4:]), ['e', 'f'])
+            self.assertEqual(len(slot1._getOrdering()), 6)
+        finally:
+            tm1.abort()
+            tm2.abort()
+            conn1.close()
+            conn2.close()
+            db.close()
+            shutil.rmtree(tmp)
+
+    def testSlotMigration(self):
+        from Products.CompositePage.slot import Slot
+        from OFS.Folder import Folder
+        slot = Slot('slot')
+        # Slots made before 1.1 keep their order in a tuple.
+        slot.__dict__['_objects'] = infos('f', 'g')
+        slot.f = Folder('f')
+        slot.g = Folder('g')
+        self.assertEqual(list(slot.objectIds()), ['f', 'g'])
+        self.assertEqual(slot._ordering, None)
+        slot.reorder('g', 0)
+        self.assertEqual(list(slot.objectIds()), ['g', 'f'])
+        self.assertFalse(slot.__dict__.has_key('_objects'))
+        slot._setObject('h', Folder('h'))
+        slot._delObject('g')
+        self.assertEqual(list(slot.objectIds()), ['f', 'h'])
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(OrderingTests))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
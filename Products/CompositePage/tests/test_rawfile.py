@@ -0,0 +1,251 @@
+##############################################################################
+#
+# Copyright (c) 2011 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.0 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Raw file tests.
+
+$Id$
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from cStringIO import StringIO
+from gzip import GzipFile
+
+
+class FakeRequest:
+
+    def __init__(self, **headers):
+        self.headers = {}
+        for name, value in headers.items():
+            self.headers[name.lower().replace('_', '-')] = value
+
+    def get_header(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+
+class FakeResponse:
+
+    def __init__(self):
+        self.headers = {}
+        self.status = 200
+
+    def setHeader(self, name, value):
+        self.headers[name.lower()] = value
+
+    def setStatus(self, status):
+        self.status = status
+
+    compress = 0
+
+    def enableHTTPCompression(self, REQUEST={}, force=0, disable=0, query=0):
+        return self.compress
+
+
+class FakeParent:
+
+    def __init__(self, url):
+        self.url = url
+
+    def absolute_url(self):
+        return self.url
+
+
+class RawFileTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self._write('script.js', 'var x = 1;\n' * 100)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _write(self, name, data):
+        f = open(os.path.join(self.dir, name), 'wb')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+
+    def _makeFile(self, name='script.js', content_type='text/javascript'):
+        from Products.CompositePage.rawfile import RawFile
+        return RawFile(name, content_type, self.dir)
+
+    def testServeFromMemory(self):
+        f = self._makeFile()
+        os.remove(os.path.join(self.dir, 'script.js'))
+        response = FakeResponse()
+        data = f(FakeRequest(), response)
+        self.assertEqual(data, 'var x = 1;\n' * 100)
+        self.assertEqual(response.headers['content-type'], 'text/javascript')
+        self.assertTrue(response.headers['etag'].startswith('"'))
+        self.assertEqual(response.headers['vary'], 'Accept-Encoding')
+
+    def testIfNoneMatch(self):
+        f = self._makeFile()
+        response = FakeResponse()
+        f(FakeRequest(), response)
+        etag = response.headers['etag']
+        response = FakeResponse()
+        self.assertEqual(f(FakeRequest(If_None_Match=etag), response), '')
+        self.assertEqual(response.status, 304)
+        response = FakeResponse()
+        data = f(FakeRequest(If_None_Match='"other"'), response)
+        self.assertEqual(data, 'var x = 1;\n' * 100)
+        self.assertEqual(response.status, 200)
+
+    def testGzip(self):
+        f = self._makeFile()
+        response = FakeResponse()
+        data = f(FakeRequest(Accept_Encoding='deflate, gzip'), response)
+        self.assertEqual(response.headers['content-encoding'], 'gzip')
+        self.assertEqual(GzipFile(fileobj=StringIO(data)).read(),
+                         'var x = 1;\n' * 100)
+        response = FakeResponse()
+        f(FakeRequest(Accept_Encoding='gzip;q=0'), response)
+        self.assertFalse('content-encoding' in response.headers)
+
+    def testPublisherCompression(self):
+        f = self._makeFile()
+        response = FakeResponse()
+        f(FakeRequest(Accept_Encoding='gzip'), response)
+        gzip_etag = response.headers['etag']
+        # ZPublisher compresses the body, so the file sends it plain.
+        response = FakeResponse()
+        response.compress = 1
+        data = f(FakeRequest(Accept_Encoding='gzip'), response)
+        self.assertEqual(data, 'var x = 1;\n' * 100)
+        self.assertFalse('content-encoding' in response.headers)
+        self.assertEqual(response.headers['etag'], gzip_etag)
+
+    def testImagesNotCompressed(self):
+        self._write('image.gif', 'GIF89a')
+        f = self._makeFile('image.gif', 'image/gif')
+        response = FakeResponse()
+        data = f(FakeRequest(Accept_Encoding='gzip'), response)
+        self.assertEqual(data, 'GIF89a')
+        self.assertFalse('content-encoding' in response.headers)
+
+    def testReloadInDebugMode(self):
+        import Globals
+        f = self._makeFile()
+        old_mode = Globals.DevelopmentMode
+        Globals.DevelopmentMode = 1
+        try:
+            self._write('script.js', 'var y = 2;\n')
+            os.utime(os.path.join(self.dir, 'script.js'), (1, 1))
+            self.assertEqual(f(), 'var y = 2;\n')
+        finally:
+            Globals.DevelopmentMode = old_mode
+
+    def testInterpolatedFile(self):
+        from Products.CompositePage.rawfile import InterpolatedFile
+        self._write('style.css', 'a { background: url(%(parent_url)s/x); }')
+        f = InterpolatedFile('style.css', 'text/css', self.dir)
+        a = f.__of__(FakeParent('http://a.example.com/ui'))
+        b = f.__of__(FakeParent('http://b.example.com/ui'))
+        response_a = FakeResponse()
+        data_a = a(FakeRequest(), response_a)
+        self.assertEqual(data_a,
+                         'a { background: url(http://a.example.com/ui/x); }')
+        # The interpolated text is cached per parent URL.
+        self.assertTrue(a(FakeRequest(), FakeResponse()) is data_a)
+        response_b = FakeResponse()
+        data_b = b(FakeRequest(), response_b)
+        self.assertEqual(data_b,
+                         'a { background: url(http://b.example.com/ui/x); }')
+        self.assertNotEqual(response_a.headers['etag'],
+                            response_b.headers['etag'])
+        self.assertTrue(response_a.headers['last-modified'])
+        response = FakeResponse()
+        etag = response_a.headers['etag']
+        self.assertEqual(a(FakeRequest(If_None_Match=etag), response), '')
+        self.assertEqual(response.status, 304)
+        response = FakeResponse()
+        self.assertEqual(b(FakeRequest(If_None_Match=etag), response), data_b)
+
+    def testFingerprintedURL(self):
+        f = self._makeFile()
+        fingerprint = f.fingerprint()
+        self.assertEqual(len(fingerprint), 12)
+        response = FakeResponse()
+        view = f.__bobo_traverse__(None, fingerprint)
+        self.assertEqual(view(FakeRequest(), response), 'var x = 1;\n' * 100)
+        self.assertEqual(response.headers['cache-control'],
+                         'public, max-age=31536000, immutable')
+        # An outdated fingerprint gets the current content, briefly.
+        response = FakeResponse()
+        view = f.__bobo_traverse__(None, '0123456789ab')
+        self.assertEqual(view(FakeRequest(), response), 'var x = 1;\n' * 100)
+        self.assertEqual(response.headers['cache-control'],
+                         'public, max-age=3600')
+        # Attributes remain reachable.
+        self.assertEqual(f.__bobo_traverse__(None, 'HEAD'), f.HEAD)
+
+    def testInterpolateAssetURL(self):
+        from Products.CompositePage.rawfile import InterpolatedFile
+        self._write('style.css', 'a { background: url(%(asset:script)s); }')
+        parent = FakeParent('http://a.example.com/ui')
+        parent.script = self._makeFile()
+        f = InterpolatedFile('style.css', 'text/css', self.dir)
+        self.assertEqual(f.__of__(parent)(),
+                         'a { background: url(http://a.example.com/ui/'
+                         'script/%s); }' % parent.script.fingerprint())
+
+    def testBundle(self):
+        from App.Common import rfc1123_date
+        from Products.CompositePage.rawfile import BundleFile
+        self._write('a.js', '// First\nfunction a() {\n    return 1;\n}\n')
+        self._write('b.js', '\n\nvar b = a();\n')
+        parent = FakeParent('http://a.example.com/ui')
+        parent.a_js = self._makeFile('a.js')
+        parent.b_js = self._makeFile('b.js')
+        bundle = BundleFile(('a_js', 'b_js'), 'text/javascript')
+        bundle = bundle.__of__(parent)
+        response = FakeResponse()
+        data = bundle(FakeRequest(), response)
+        self.assertEqual(data, 'function a() {\nreturn 1;\n}\nvar b = a();')
+        self.assertTrue(bundle() is data)
+        self.assertEqual(len(bundle.fingerprint()), 12)
+        # The bundle was last modified with its newest file.
+        newest = max(parent.a_js.lmt, parent.b_js.lmt)
+        self.assertEqual(bundle._getLastModified()[0], newest)
+        self.assertEqual(response.headers['last-modified'],
+                         rfc1123_date(newest))
+        # The bundle is rebuilt when a member changes.
+        import Globals
+        old_mode = Globals.DevelopmentMode
+        Globals.DevelopmentMode = 1
+        try:
+            self._write('b.js', 'var b = 2;\n')
+            os.utime(os.path.join(self.dir, 'b.js'), (1, 1))
+            self.assertEqual(bundle(),
+                             'function a() {\nreturn 1;\n}\nvar b = 2;')
+            self.assertEqual(bundle._getLastModified()[0], parent.a_js.lmt)
+        finally:
+            Globals.DevelopmentMode = old_mode
+
+    def testMinifyCSS(self):
+        from Products.CompositePage.rawfile import minifyCSS
+        self.assertEqual(minifyCSS('/* x\n y */\na {\n  color: red; /* c */\n'
+                                   '}\n\n'), 'a {\ncolor: red;\n}')
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(RawFileTests))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
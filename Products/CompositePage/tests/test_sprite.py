@@ -0,0 +1,115 @@
+##############################################################################
+#
+# Copyright (c) 2011 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.0 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Sprite tests.
+
+$Id$
+"""
+
+import imp
+import os
+import struct
+import unittest
+import zlib
+
+_here = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_manual = os.path.join(_here, 'manual')
+
+# The sprite is built by a script, not by the product.
+make_sprite = imp.load_source(
+    'make_sprite', os.path.join(_manual, 'make_sprite.py'))
+buildSprite = make_sprite.buildSprite
+decodeGIF = make_sprite.decodeGIF
+ImageError = make_sprite.ImageError
+
+
+def read_file(name, dir=_manual):
+    f = open(os.path.join(dir, name), 'rb')
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+
+def read_png(data):
+    """Returns (width, height, rows) from a PNG written by encodePNG.
+    """
+    assert data[:8] == '\x89PNG\r\n\x1a\n'
+    pos = 8
+    idat = []
+    while pos < len(data):
+        size, = struct.unpack('>I', data[pos:pos + 4])
+        kind = data[pos + 4:pos + 8]
+        chunk = data[pos + 8:pos + 8 + size]
+        crc, = struct.unpack('>I', data[pos + 8 + size:pos + 12 + size])
+        assert zlib.crc32(kind + chunk) & 0xffffffff == crc
+        if kind == 'IHDR':
+            width, height = struct.unpack('>II', chunk[:8])
+        elif kind == 'IDAT':
+            idat.append(chunk)
+        pos += 12 + size
+    raw = zlib.decompress(''.join(idat))
+    stride = width * 4 + 1
+    rows = [raw[i + 1:i + stride] for i in range(0, len(raw), stride)]
+    return width, height, rows
+
+
+class SpriteTests(unittest.TestCase):
+
+    def testDecodeGIF(self):
+        for name in os.listdir(_manual):
+            if name.endswith('.gif'):
+                width, height, rows = decodeGIF(read_file(name))
+                self.assertEqual((width, height), (16, 16))
+                self.assertEqual(len(rows), 16)
+                for row in rows:
+                    self.assertEqual(len(row), 64)
+
+    def testTransparency(self):
+        # The slot icon is a square with a transparent border.
+        gif = read_file('slot.gif', os.path.join(_here, 'www'))
+        width, height, rows = decodeGIF(gif)
+        self.assertEqual(rows[0][:4], '\0\0\0\0')
+        self.assertEqual(rows[8][32:36][3], '\xff')
+
+    def testNotGIF(self):
+        self.assertRaises(ImageError, decodeGIF, '\x89PNG\r\n\x1a\n')
+
+    def testBuildSprite(self):
+        names = ('add.gif', 'cut.gif', 'paste.gif')
+        data, layout = buildSprite([(name, read_file(name)) for name in names])
+        self.assertEqual(layout, {'add.gif': (0, 0, 16, 16),
+                                  'cut.gif': (0, 16, 16, 16),
+                                  'paste.gif': (0, 32, 16, 16)})
+        width, height, rows = read_png(data)
+        self.assertEqual((width, height), (16, 48))
+        self.assertEqual(rows[16:32], decodeGIF(read_file('cut.gif'))[2])
+
+    def testUpToDate(self):
+        # icons.png and manual_styles.css match the icons.
+        images = [(name, read_file(name)) for name, selector
+                  in make_sprite.IMAGES]
+        data, layout = buildSprite(images)
+        self.assertEqual(read_png(read_file('icons.png')), read_png(data))
+        css = read_file('manual_styles.css')
+        self.assertTrue(make_sprite.BEGIN + make_sprite.makeRules(layout)
+                        + make_sprite.END in css)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(SpriteTests))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
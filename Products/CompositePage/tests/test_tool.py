@@ -36,6 +36,30 @@ class PermissiveSecurityPolicy:
         return 1
 
 
+class FakeResponse:
+
+    def __init__(self):
+        self.cookies = {}
+
+    def setCookie(self, name, value, **kw):
+        self.cookies[name] = value
+
+    def expireCookie(self, name, **kw):
+        self.cookies[name] = None
+
+    def redirect(self, url):
+        self.redirected = url
+
+
+class FakeRequest(dict):
+
+    def __init__(self):
+        self.SESSION = {}
+        self['RESPONSE'] = FakeResponse()
+        self['BASEPATH1'] = ''
+        self['HTTP_REFERER'] = 'http://localhost/page'
+
+
 class ToolTests(unittest.TestCase):
 
     def setUp(self):
@@ -94,6 +118,101 @@ class ToolTests(unittest.TestCase):
         self.assertEqual(list(self.slot.objectIds()), ["f", "g"])
         self.assertEqual(list(self.root.otherslot.objectIds()), [])
 
+    def testApplyOperations(self):
+        h = Folder()
+        h._setId("h")
+        self.slot._setObject(h.id, h)
+        self.tool.applyOperations([
+            ('move', ["/slot/h"], "/otherslot", 0),
+            ('move', ["/slot/g"], "/slot", 0),
+            ('copy', ["/otherslot/h"], "/slot", 1),
+            ('delete', ["/slot/f"]),
+            ('move', ["/otherslot/h", "/slot/g"], "/otherslot", 0),
+            ])
+        self.assertEqual(list(self.slot.objectIds()), ["h"])
+        self.assertEqual(list(self.root.otherslot.objectIds()), ["h", "g"])
+        # Nothing changes when an operation fails.
+        self.assertRaises(KeyError, self.tool.applyOperations, [
+            ('move', ["/slot/h"], "/otherslot", 0),
+            ('delete', ["/slot/nonexistent"]),
+            ])
+        self.assertEqual(list(self.slot.objectIds()), ["h"])
+        self.assertEqual(list(self.root.otherslot.objectIds()), ["h", "g"])
+
+    def testCopy(self):
+        from Products.CompositePage.element import CompositeElement
+        from Products.CompositePage.utils import copiesOf
+        self.tool.moveElements(["/slot/f", "/slot/g"], "/otherslot", 0, 1)
+        self.assertEqual(list(self.slot.objectIds()), ["f", "g"])
+        self.assertEqual(list(self.root.otherslot.objectIds()), ["f", "g"])
+        e = CompositeElement("e", self.slot.f)
+        e.template_name = "summary"
+        e.manage_setLocalRoles("bob", ["Owner"])
+        copy, folder = copiesOf([e, self.slot.f.aq_base])
+        self.assertEqual((copy.getId(), copy.path, copy.template_name),
+                         ("e", e.path, "summary"))
+        copy.manage_setLocalRoles("bob", ["Manager"])
+        self.assertEqual(e.get_local_roles_for_userid("bob"), ("Owner",))
+        # Other objects are pickled.
+        self.assertEqual(folder.getId(), "f")
+        self.assertFalse(folder is self.slot.f.aq_base)
+
+    def testCopyFallback(self):
+        from Products.CompositePage import element
+        from Products.CompositePage.element import CompositeElement
+        e = CompositeElement("e", self.slot.f)
+        e.settings = {"sizes": [1, 2], "names": ("a", u"b")}
+        copied = []
+        orig = element.copyOf
+        def copyOf(ob):
+            copied.append(ob)
+            return orig(ob)
+        element.copyOf = copyOf
+        try:
+            copy = e.copyElement()
+            self.assertEqual(copied, [])
+            self.assertEqual(copy.settings, e.settings)
+            self.assertFalse(copy.settings["sizes"] is e.settings["sizes"])
+            # Objects nested anywhere in the state are pickled.
+            e.settings["sizes"].append(Folder())
+            copy = e.copyElement()
+            self.assertEqual(copied, [e])
+            self.assertFalse(copy.settings["sizes"][2]
+                             is e.settings["sizes"][2])
+            # So are large containers.
+            del copied[:]
+            e.settings["sizes"] = range(2000)
+            e.copyElement()
+            self.assertEqual(copied, [e])
+        finally:
+            element.copyOf = orig
+
+    def testCopySharedSubobjects(self):
+        from Products.CompositePage.utils import copiesOf
+        f, g = self.slot.f.aq_base, self.slot.g.aq_base
+        f.shared = g.shared = Folder()
+        f_copy, g_copy = copiesOf([f, g])
+        self.assertTrue(f_copy.shared is g_copy.shared)
+        self.assertFalse(f_copy.shared is f.shared)
+
+    def testSessionClipboard(self):
+        self.tool.clipboard_storage = 'session'
+        request = FakeRequest()
+        self.tool.useClipboard('cut', request, source_paths='/slot/f:/slot/g')
+        cookie = request['RESPONSE'].cookies['__cp']
+        self.assertTrue(cookie.startswith('cps:'))
+        self.assertTrue(len(cookie) < 40)
+        request['__cp'] = cookie
+        self.tool.useClipboard('paste', request, target_path='/otherslot',
+                               target_index='0')
+        self.assertEqual(list(self.slot.objectIds()), [])
+        self.assertEqual(list(self.root.otherslot.objectIds()), ["f", "g"])
+        self.assertEqual(request['RESPONSE'].cookies['__cp'], None)
+        self.assertEqual(request.SESSION, {})
+        # The clipboard can only be pasted once.
+        self.assertRaises(CompositeError, self.tool.useClipboard, 'paste',
+                          request, target_path='/slot', target_index='0')
+
     def testMoveAndDelete(self):
         self.assertEqual(list(self.slot.objectIds()), ["f", "g"])
         self.assertEqual(list(self.root.otherslot.objectIds()), [])
@@ -16,6 +16,8 @@
 $Id: tool.py,v 1.11 2004/03/02 20:41:44 shane Exp $
 """
 
+from uuid import uuid4
+
 import Globals
 from Acquisition import aq_base, aq_parent, aq_inner
 from OFS.SimpleItem import SimpleItem
@@ -29,11 +31,16 @@ from Products.CompositePage.interfaces import ISlot
 from Products.CompositePage.interfaces import ISlotClass
 from Products.CompositePage.interfaces import CompositeError
 from Products.CompositePage.element import CompositeElement
-from Products.CompositePage.utils import copyOf
+from Products.CompositePage.utils import copiesOf
 
 
 _uis = {}
 
+# The __cp cookie of a clipboard kept in the session is this prefix
+# and a token.  Encoded clipboards never contain a colon.
+_clipboard_prefix = 'cps:'
+_clipboard_key = 'composite_clipboard'
+
 def registerUI(name, obj):
     """Registers a page design UI for use with the composite tool.
 
@@ -83,9 +90,23 @@ class CompositeTool(Folder):
     _properties = Folder._properties + (
         {'id': 'default_inline_templates', 'mode': 'w', 'type': 'lines',
          'label': 'Default inline template names',},
+        {'id': 'fragment_cache_size', 'mode': 'w', 'type': 'int',
+         'label': 'Maximum number of cached element renderings',},
+        {'id': 'render_threads', 'mode': 'w', 'type': 'int',
+         'label': 'Threads for rendering elements concurrently',},
+        {'id': 'render_timeout', 'mode': 'w', 'type': 'float',
+         'label': 'Seconds to wait for an element rendered concurrently',},
+        {'id': 'clipboard_storage', 'mode': 'w', 'type': 'selection',
+         'select_variable': 'clipboard_storages',
+         'label': 'Where to keep cut and copied elements',},
         )
 
     default_inline_templates = ()
+    fragment_cache_size = 1000
+    render_threads = 4
+    render_timeout = 10.0
+    clipboard_storage = 'cookie'
+    clipboard_storages = ('cookie', 'session')
 
     _check_security = 1  # Turned off in unit tests
 
@@ -99,7 +120,93 @@ class CompositeTool(Folder):
     def moveElements(self, source_paths, target_path, target_index, copy=0):
         """Moves or copies elements to a slot.
         """
-        target_index = int(target_index)
+        if copy:
+            op = 'copy'
+        else:
+            op = 'move'
+        self.applyOperations([(op, source_paths, target_path, target_index)])
+
+
+    security.declarePublic("deleteElements")
+    def deleteElements(self, source_paths):
+        self.applyOperations([('delete', source_paths)])
+
+
+    security.declarePublic("applyOperations")
+    def applyOperations(self, operations):
+        """Moves, copies and deletes elements in one pass.
+
+        operations is a sequence of ('move', source_paths, target_path,
+        target_index), ('copy', source_paths, target_path,
+        target_index) and ('delete', source_paths).  The operations
+        apply in order, each to the result of the ones before it, as
+        if moveElements() and deleteElements() had been called.
+
+        Every path is traversed once and security is checked before
+        any change is made.  The contents and order of each affected
+        slot are then changed in a single pass.
+        """
+        changes = {}  # (base, slot path) -> _SlotChanges
+        root = self.getPhysicalRoot()
+        for operation in operations:
+            op = operation[0]
+            if op == 'delete':
+                self._planDelete(changes, operation[1])
+            elif op in ('move', 'copy'):
+                source_paths, target_path, target_index = operation[1:]
+                self._planMove(changes, root, source_paths, target_path,
+                               int(target_index), op == 'copy')
+            else:
+                raise ValueError("Unknown operation: %s" % op)
+        slots = []
+        for slot_changes in changes.values():
+            if slot_changes not in slots:
+                slots.append(slot_changes)
+        try:
+            for slot_changes in slots:
+                slot_changes.removeObjects()
+        finally:
+            # Clear the nulls just added.
+            for slot_changes in slots:
+                slot_changes.slot.pack()
+        for slot_changes in slots:
+            slot_changes.addObjects()
+
+    def _getSlotChanges(self, changes, base, path):
+        key = (base is self, tuple(path))
+        res = changes.get(key)
+        if res is None:
+            slot = base.restrictedTraverse(path)
+            assert ISlot.providedBy(slot), repr(slot)
+            # Two paths may lead to the same slot.
+            for other in changes.values():
+                if aq_base(other.slot) is aq_base(slot):
+                    res = other
+                    break
+            else:
+                res = _SlotChanges(slot)
+            changes[key] = res
+        return res
+
+    def _planDelete(self, changes, source_paths):
+        sources = []
+        for p in source_paths:
+            if hasattr(p, "split"):
+                p = p.split('/')
+            if p:
+                sources.append(p)
+
+        # Replace with nulls to avoid changing indexes while deleting.
+        touched = []
+        for source in sources:
+            slot_changes = self._getSlotChanges(changes, self, source[:-1])
+            slot_changes.nullify(source[-1])
+            touched.append(slot_changes)
+        for slot_changes in touched:
+            slot_changes.pack()
+
+    def _planMove(self, changes, root, source_paths, target_path,
+                  target_index, copy):
         # Coerce the paths to sequences of path elements.
         if hasattr(target_path, "split"):
             target_path = target_path.split('/')
@@ -128,79 +235,41 @@ class CompositeTool(Folder):
 
         # Gather the sources, checking interfaces and security before
         # making any changes.
-        root = self.getPhysicalRoot()
         elements = []
-        target = root.restrictedTraverse(target_path)
-        assert ISlot.providedBy(target), repr(target)
+        target = self._getSlotChanges(changes, root, target_path)
         for source in sources:
-            slot = root.restrictedTraverse(source[:-1])
-            assert ISlot.providedBy(slot), repr(slot)
-            element = slot.restrictedTraverse(source[-1])
+            slot_changes = self._getSlotChanges(changes, root, source[:-1])
+            element = slot_changes.get(source[-1])
             elements.append(element)
             if self._check_security:
-                target._verifyObjectPaste(element)
-
-        changed_slots = {}  # id(aq_base(slot)) -> slot
-        try:
-            if not copy:
-                # Replace items with nulls to avoid changing indexes
-                # while moving.
-                for source in sources:
-                    slot = root.restrictedTraverse(source[:-1])
-                    slot_id = id(aq_base(slot))
-                    if not changed_slots.has_key(slot_id):
-                        changed_slots[slot_id] = slot
-                    # Check security
-                    nullify = guarded_getattr(slot, "nullify")
-                    nullify(source[-1])
-
-            # Add the elements and reorder.
-            for element in elements:
-
-                if not ICompositeElement.providedBy(element):
-                    # Make a composite element wrapper.
-                    element = CompositeElement(element.getId(), element)
-
-                element = aq_base(element)
-                new_id = target._get_id(element.getId())
-                if copy:
-                    element = copyOf(element)
-                element._setId(new_id)
-                target._setObject(new_id, element)
-                # Check security
-                reorder = guarded_getattr(target, "reorder")
-                reorder(new_id, target_index)
-                target_index += 1
-        finally:
-            # Clear the nulls just added.
-            for slot in changed_slots.values():
-                slot.pack()
-
-
-    security.declarePublic("deleteElements")
-    def deleteElements(self, source_paths):
-        sources = []
-        for p in source_paths:
-            if hasattr(p, "split"):
-                p = p.split('/')
-            if p:
-                sources.append(p)
+                target.slot._verifyObjectPaste(element)
 
-        # Replace with nulls to avoid changing indexes while deleting.
-        orig_slots = {}
-        try:
+        touched = [target]
+        if not copy:
+            # Replace items with nulls to avoid changing indexes
+            # while moving.
             for source in sources:
-                slot = self.restrictedTraverse(source[:-1])
-                assert ISlot.providedBy(slot), repr(slot)
-                slot_id = id(aq_base(slot))
-                if not orig_slots.has_key(slot_id):
-                    orig_slots[slot_id] = slot
-                nullify = guarded_getattr(slot, "nullify")  # Check security
-                nullify(source[-1])
-        finally:
-            # Clear the nulls just added.
-            for slot in orig_slots.values():
-                slot.pack()
+                slot_changes = self._getSlotChanges(
+                    changes, root, source[:-1])
+                slot_changes.nullify(source[-1])
+                touched.append(slot_changes)
+
+        # Add the elements.
+        added = []
+        for element in elements:
+            if not ICompositeElement.providedBy(element):
+                # Make a composite element wrapper.
+                element = CompositeElement(element.getId(), element)
+            added.append(aq_base(element))
+        if copy:
+            added = copiesOf(added)
+        for element in added:
+            target.insert(target_index, element)
+            target_index += 1
+
+        # Clear the nulls just added.
+        for slot_changes in touched:
+            slot_changes.pack()
 
 
     security.declarePublic("moveAndDelete")
@@ -232,14 +301,14 @@ class CompositeTool(Folder):
             cut = (func == 'cut')
             for p in str(source_paths).split(':'):
                 items.append(p.split('/'))
-            data = _cb_encode((cut, items))
+            data = self._storeClipboard(REQUEST, (cut, items))
             resp.setCookie('__cp', data, path=cookie_path(REQUEST))
         elif func == 'paste':
             assert target_path
             assert target_index
             assert REQUEST is not None
             data = REQUEST['__cp']
-            cut, items = _cb_decode(data)
+            cut, items = self._loadClipboard(REQUEST, data)
             self.moveElements(
                 items, target_path, int(target_index), not cut)
             resp.expireCookie('__cp', path=cookie_path(REQUEST))
@@ -247,9 +316,129 @@ class CompositeTool(Folder):
             raise ValueError("Clipboard function %s unknown" % func)
         resp.redirect(REQUEST["HTTP_REFERER"])
 
+    def _storeClipboard(self, REQUEST, clipboard):
+        """Returns the __cp cookie value for (cut, items).
+
+        With session storage, the cookie holds only a token and the
+        paths stay on the server.
+        """
+        if self.clipboard_storage != 'session':
+            return _cb_encode(clipboard)
+        token = uuid4().hex
+        cut, items = clipboard
+        items = tuple([tuple(item) for item in items])
+        # A new cut or copy replaces the previous one.
+        REQUEST.SESSION[_clipboard_key] = (token, cut, items)
+        return _clipboard_prefix + token
+
+    def _loadClipboard(self, REQUEST, data):
+        """Returns (cut, items) for a __cp cookie value.
+
+        The paths are traversed again when pasting, so security is
+        checked either way.
+        """
+        if not data.startswith(_clipboard_prefix):
+            return _cb_decode(data)
+        session = REQUEST.SESSION
+        stored = session.get(_clipboard_key)
+        if stored is None or stored[0] != data[len(_clipboard_prefix):]:
+            raise CompositeError("The clipboard is empty or has expired")
+        del session[_clipboard_key]
+        return stored[1:]
+
 Globals.InitializeClass(CompositeTool)
 
 
+class _SlotChanges:
+    """The pending changes to one slot, planned by applyOperations().
+
+    Keeps the order of the slot in memory.  Nothing changes in the
+    slot until removeObjects() and addObjects() are called.
+    """
+
+    def __init__(self, slot):
+        self.slot = slot
+        self.order = list(slot.objectIds())
+        self.present = {}  # id -> 1
+        for id in self.order:
+            self.present[id] = 1
+        self.removed = {}  # id -> 1 for original contents to remove
+        self.added = {}  # id -> element
+        self._nullify = None
+        self._reorder = None
+
+    def get(self, name):
+        """Returns an element, which may have been added by the plan.
+        """
+        element = self.added.get(name)
+        if element is not None:
+            return element
+        if not self.present.has_key(name):
+            raise KeyError(name)
+        return self.slot.restrictedTraverse(name)
+
+    def nullify(self, name):
+        if not self.present.has_key(name):
+            raise KeyError(name)
+        if self._nullify is None:
+            self._nullify = guarded_getattr(self.slot, "nullify")
+        self.order[self.order.index(name)] = None
+        del self.present[name]
+        if self.added.has_key(name):
+            del self.added[name]
+        else:
+            self.removed[name] = 1
+
+    def pack(self):
+        self.order = [id for id in self.order if id is not None]
+
+    def insert(self, index, element):
+        if self._reorder is None:
+            self._reorder = guarded_getattr(self.slot, "reorderAfter")
+        new_id = self._getId(element.getId())
+        self.order.insert(index, new_id)
+        self.present[new_id] = 1
+        self.added[new_id] = element
+
+    def _getId(self, id):
+        # Like CopySupport._get_id(), but sees the planned contents.
+        n = 0
+        new_id = id
+        while (self.present.has_key(new_id) or (
+            not self.removed.has_key(new_id)
+            and self.slot._getOb(new_id, None) is not None)):
+            n += 1
+            if n > 1:
+                new_id = 'copy%d_of_%s' % (n, id)
+            else:
+                new_id = 'copy_of_%s' % id
+        return new_id
+
+    def removeObjects(self):
+        for name in self.removed.keys():
+            self._nullify(name)
+
+    def addObjects(self):
+        """Adds the new elements and puts them in order.
+        """
+        if not self.added:
+            return
+        # _setObject() appends; the original contents keep their
+        # relative order, so placing each new element right after its
+        # predecessor in the plan, in ascending order, puts everything
+        # where it belongs.
+        for id in self.order:
+            if self.added.has_key(id):
+                element = self.added[id]
+                element._setId(id)
+                self.slot._setObject(id, element)
+        previous = None
+        for id in self.order:
+            if self.added.has_key(id):
+                self._reorder(id, previous)
+            previous = id
+
+
 def manage_addCompositeTool(dispatcher, REQUEST=None):
     """Adds a composite tool to a folder.
     """
@@ -21,6 +21,11 @@ $Id: utils.py,v 1.1 2003/12/28 04:32:47 shane Exp $
 from cStringIO import StringIO
 from cPickle import Pickler, Unpickler
 
+from AccessControl import getSecurityManager
+from Acquisition import aq_base
+
+from Products.CompositePage.interfaces import ICopyableElement
+
 
 def copyOf(source):
     """Copies a ZODB object, loading subobjects as needed.
@@ -68,3 +73,53 @@ def copyOf(source):
     u.persistent_load = persistent_load
     return u.load()
 
+
+def copiesOf(sources):
+    """Copies several ZODB objects.
+
+    Elements that provide ICopyableElement copy themselves.  The
+    others are pickled together, so subobjects they share are loaded
+    and copied once.  Returns the copies in the order of the sources.
+    """
+    res = list(sources)
+    pickled = []
+    for i in range(len(res)):
+        if ICopyableElement.providedBy(res[i]):
+            res[i] = res[i].copyElement()
+        else:
+            pickled.append(i)
+    if pickled:
+        copies = copyOf([res[i] for i in pickled])
+        for i, ob in zip(pickled, copies):
+            res[i] = ob
+    return res
+
+
+def getSerial(ob):
+    """Returns (oid, serial) for a stored persistent object.
+
+    Returns None for objects that have never been stored or that have
+    unsaved changes, since their serial says nothing about their state.
+    """
+    base = aq_base(ob)
+    if getattr(base, '_p_oid', None) is None or base._p_changed:
+        return None
+    if base._p_changed is None:
+        # Ghosts don't know their serial until loaded.
+        base._p_activate()
+    return (base._p_oid, base._p_serial)
+
+
+def getUserKey(context):
+    """Returns what a rendering for the current user may depend on.
+
+    That is the user's roles in the context and, for users who are
+    logged in, the user id, since their renderings may be personal.
+    Anonymous renderings depend on the roles alone.
+    """
+    user = getSecurityManager().getUser()
+    roles = list(user.getRolesInContext(context))
+    roles.sort()
+    if user.getUserName() == 'Anonymous User':
+        return (None, tuple(roles))
+    return (user.getId(), tuple(roles))